@@ -0,0 +1,411 @@
+# bench.py
+
+import asyncio
+
+from argparse import ArgumentParser
+from bot import Args, Bot, CommandRouter, ConfirmationRegistry, ErrorReporter, Metrics, RateLimiter, WebClient, write_strikes
+from configparser import ConfigParser
+from json import dumps, loads
+from os import chdir, getcwd
+from os.path import abspath, isfile
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+
+# a stand-in command with the attributes the router reads
+def fake_command(admin_only=False, aliases=()):
+    async def cmd(*args, **kwargs):
+        pass
+    cmd.admin_only = admin_only
+    cmd.aliases = aliases
+    return cmd
+
+# build a router with the bot's commands
+def make_router():
+    router = CommandRouter('!')
+    for name, admin_only, aliases in [('help', False, ('commands',)), ('restart', True, ()), ('teststream', True, ()),
+                                      ('setpresence', True, ()), ('listgames', False, ('games',)), ('rolecall', True, ()),
+                                      ('rolehistory', True, ()), ('linkgame', True, ()), ('unlinkgame', True, ()),
+                                      ('strike', True, ()), ('destrike', True, ()), ('strikes', True, ()),
+                                      ('strikeids', True, ()), ('strikesfile', True, ())]:
+        router.add(name, fake_command(admin_only, aliases), None)
+
+    return router
+
+# time how many messages a second the router can parse, look up and check the arguments of
+def bench_router(count=100000):
+    router = make_router()
+    schema = Args(max=1)
+    messages = ['!help', '!HELP strike', '!listgames', '!games', '!strikes', '!hlep', '!lsitgames', '!nothing at all']
+
+    start = perf_counter()
+    for i in range(count):
+        command, args = router.parse(messages[i % len(messages)])
+        if router.find(command, True) is not None:
+            schema.parse(args[:1], [], [])
+        else:
+            router.suggest(command, True)
+    router_elapsed = perf_counter() - start
+
+    print('router: {:.0f} messages/s ({:.2f} us each)'.format(count / router_elapsed, router_elapsed / count * 1e6))
+
+    # suggestions for unknown commands which haven't been seen before
+    start = perf_counter()
+    for i in range(count // 10):
+        router.suggestions.clear()
+        router.suggest(messages[5 + i % 3][1:].split()[0], True)
+    elapsed = perf_counter() - start
+
+    print('router suggestions (uncached): {:.0f} /s ({:.2f} us each)'.format(count // 10 / elapsed, elapsed / (count // 10) * 1e6))
+
+    return {'router': {'count': count, 'throughput': count / router_elapsed}}
+
+# STAND-INS
+
+class FakeRole:
+    def __init__(self, id, name, default=False):
+        self.id = id
+        self.name = name
+        self.colour = 0
+        self.mention = '<@&{}>'.format(id)
+        self.default = default
+
+    def is_default(self):
+        return self.default
+
+class FakeMember:
+    def __init__(self, id, name, roles=()):
+        self.id = id
+        self.name = name
+        self.roles = list(roles)
+        self.bot = False
+        self.mention = '<@{}>'.format(id)
+        self.avatar_url = ''
+
+        # the messages sent to them
+        self.sent = 0
+
+    def __str__(self):
+        return '{}#{:04d}'.format(self.name, self.id % 10000)
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+
+    async def edit(self, roles=None, nick=None):
+        if roles is not None:
+            self.roles = list(roles)
+
+class FakeChannel:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+        # the number of messages sent to the channel
+        self.sent = 0
+
+    async def send(self, content=None, embed=None, file=None):
+        self.sent += 1
+        return FakeMessage(content, None, self)
+
+class FakeMessage:
+    def __init__(self, content, author, channel, mentions=(), role_mentions=()):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.mentions = list(mentions)
+        self.role_mentions = list(role_mentions)
+
+    async def edit(self, content=None, embed=None):
+        pass
+
+class FakeGuild:
+    def __init__(self, id, members, roles, channels):
+        self.id = id
+        self.members = members
+        self.roles = roles
+        self.channels = {channel.id: channel for channel in channels}
+        self.me = FakeMember(1, 'Esports Bot')
+
+        self.by_id = {member.id: member for member in members}
+        self.banned = set()
+
+    def get_member(self, id):
+        return self.by_id.get(id)
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+    def get_role(self, id):
+        return next((role for role in self.roles if role.id == id), None)
+
+    # add a member, as the gateway would before dispatching the join
+    def join(self, member):
+        self.members.append(member)
+        self.by_id[member.id] = member
+
+    async def ban(self, user, reason=None, delete_message_days=1):
+        self.banned.add(user.id)
+
+    async def unban(self, user):
+        self.banned.discard(user.id)
+
+    async def bans(self):
+        return []
+
+# the bot with the gateway swapped out for the fake guild
+class BenchBot(Bot):
+    user = FakeMember(1, 'Esports Bot')
+
+    # the benchmark sends commands far faster than their cooldowns allow, so they're only checked when timing the throttling
+    throttle = False
+
+    def throttled(self, *args):
+        return Bot.throttled(self, *args) if self.throttle else None
+
+    def get_guild(self, id):
+        return self.fake_guild
+
+    def get_user(self, id):
+        return self.fake_guild.get_member(id)
+
+    async def get_user_info(self, id):
+        return self.fake_guild.get_member(id)
+
+    async def change_presence(self, activity=None):
+        pass
+
+# make a guild of the given size and a bot ready to run in it - members, strike rows and game roles
+def make_bot(members=50000, strikes=5000, games=100, seed=1):
+    rng = Random(seed)
+
+    # 10-19 are the configured roles and 1000 onwards the game roles
+    everyone = FakeRole(2, '@everyone', True)
+    admin, member, guest, first_strike, second_strike = [FakeRole(10 + i, name) for i, name in enumerate(['Admin', 'Member', 'Guest', 'First Strike', 'Second Strike'])]
+    game_roles = [FakeRole(1000 + i, 'Game {}'.format(i)) for i in range(games)]
+    channels = [FakeChannel(20, 'bot'), FakeChannel(21, 'admin'), FakeChannel(22, 'stream')]
+
+    people = []
+    for i in range(members):
+        roles = [everyone, member if rng.random() < 0.7 else guest] + rng.sample(game_roles, min(len(game_roles), rng.randint(0, 3)))
+        people.append(FakeMember(100000 + i, 'user{}'.format(i), roles))
+    people[0].roles.append(admin)
+
+    # the first members have a strike each
+    write_strikes({str(person.id): [str(person), 'Benchmarking', '', '', ''] for person in people[1:strikes + 1]}, 'strikes.csv')
+
+    bot = BenchBot.__new__(BenchBot)
+    bot.fake_guild = FakeGuild(3, people, [everyone, admin, member, guest, first_strike, second_strike] + game_roles, channels)
+
+    # what Bot.__init__ would set up, without connecting
+    bot.config = ConfigParser()
+    bot.config.read_dict({'general': {'guild': '3', 'name': 'Esports Bot', 'command_prefix': '!', 'presence': 'CPFXhelp',
+                                      'twitch_channels': '', 'snapshot': 'snapshot.json'},
+                          'channels': {'bot': '20', 'admin': '21', 'stream': '22'},
+                          'roles': {'admin': '10', 'member': '11', 'guest': '12', 'first_strike': '13', 'second_strike': '14',
+                                    'games': ' '.join(str(role.id) for role in game_roles)},
+                          'strikes': {'backend': 'csv'},
+                          # the joins come faster than any real server's, so keep them under the raid threshold to time ordinary checks
+                          'raid': {'threshold': '1000000'}})
+    bot.loop = asyncio.get_event_loop()
+    bot.web = WebClient()
+    bot.webhook = None
+    bot.confirmations = ConfirmationRegistry()
+    bot.rate_limits = RateLimiter()
+    bot.events = {}
+    bot.running_commands = set()
+    bot.metrics = Metrics()
+    bot.metrics_server = None
+    bot.errors = ErrorReporter(lambda summary: bot.admin_channel.send(embed=bot.response_embed(summary, False)))
+    bot.exit_reason = 'exit'
+    bot.ready = asyncio.Event()
+
+    return bot
+
+# BENCHMARKS
+
+# run calls one after another, or started at a steady rate if there is one, timing each from when it was due
+async def drive(calls, rate=0.):
+    latencies = []
+
+    async def timed(call, due):
+        await call()
+        latencies.append(perf_counter() - due)
+
+    start = perf_counter()
+    if rate:
+        tasks = []
+        for i, call in enumerate(calls):
+            due = start + i / rate
+            await asyncio.sleep(max(0., due - perf_counter()))
+            tasks.append(asyncio.ensure_future(timed(call, due)))
+        await asyncio.gather(*tasks)
+    else:
+        for call in calls:
+            await timed(call, perf_counter())
+    elapsed = perf_counter() - start
+
+    return summarise(latencies, elapsed)
+
+# the throughput and latency percentiles of a run
+def summarise(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100. * len(latencies)))] * 1000 if latencies else 0.
+
+    return {'count': len(latencies),
+            'throughput': len(latencies) / elapsed if elapsed else 0.,
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'p99': percentile(99),
+            'max': latencies[-1] * 1000 if latencies else 0.}
+
+# drive the bot's handlers against the fake guild
+async def bench_bot(members, strikes, games, count, strike_count, rate):
+    bot = make_bot(members, strikes, games)
+    guild = bot.fake_guild
+    rng = Random(2)
+    results = {}
+
+    start = perf_counter()
+    await Bot.on_ready.__wrapped__(bot)
+    results['on_ready'] = summarise([perf_counter() - start], perf_counter() - start)
+
+    # let the processes started by on_ready do their first runs, and make role changes straight away
+    await asyncio.sleep(1.)
+    bot.role_queue.window = 0.
+
+    admin = guild.members[0]
+
+    # commands run as their own tasks, so wait for them too
+    def on_message(message):
+        async def call():
+            task = await Bot.on_message.__wrapped__(bot, message)
+            if isinstance(task, asyncio.Future):
+                await task
+        return call
+
+    # everyday messages in the bot channel - commands, typos and chat
+    texts = ['!help', '!listgames', '!games', '!help strike', '!hlep', 'hello everyone']
+    messages = [FakeMessage(texts[i % len(texts)], rng.choice(guild.members), bot.bot_channel) for i in range(count)]
+    results['on_message'] = await drive([on_message(message) for message in messages], rate)
+
+    # every command should have run, or the timings are of something else
+    ran = sum(value for (name, labels), value in bot.metrics.counters.items() if name == 'bot_commands_total')
+    expected = sum(1 for message in messages if message.content.split()[0] in texts[:4])
+    assert ran == expected, 'only {} of {} commands ran'.format(ran, expected)
+
+    # commands over their cooldowns, which are turned away
+    bot.throttle = True
+    results['throttled'] = await drive([on_message(FakeMessage('!help', admin, bot.bot_channel)) for i in range(count)], rate)
+    bot.throttle = False
+
+    results['rolecall'] = await drive([on_message(FakeMessage('!rolecall', admin, bot.admin_channel)) for i in range(count // 10 or 1)], rate)
+    results['strikes'] = await drive([on_message(FakeMessage('!strikes', admin, bot.admin_channel)) for i in range(count // 10 or 1)], rate)
+
+    # strike members without strikes, then take the strikes away again
+    targets = guild.members[strikes + 1:strikes + 1 + strike_count]
+    results['strike'] = await drive([on_message(FakeMessage('!strike {} Benchmarking'.format(target.mention), admin, bot.admin_channel, [target])) for target in targets], rate)
+    results['destrike'] = await drive([on_message(FakeMessage('!destrike {}'.format(target.mention), admin, bot.admin_channel, [target])) for target in targets], rate)
+
+    # new members joining, some of whom have strikes
+    joins = [FakeMember(900000 + i, 'joiner{}'.format(i), [guild.roles[0]]) for i in range(count)]
+    for i, joiner in enumerate(joins[::10]):
+        bot.strike_store.update({str(joiner.id): [str(joiner), 'Benchmarking', '', '', '']})
+
+    def join(member):
+        async def call():
+            guild.join(member)
+            await Bot.on_member_join.__wrapped__(bot, member)
+        return call
+
+    # time the batch checks separately, as the joins only queue the members
+    checks = []
+    check = bot.joins.check
+
+    async def timed_check(members, started):
+        start = perf_counter()
+        await check(members, started)
+        checks.append(perf_counter() - start)
+    bot.joins.check = timed_check
+
+    results['on_member_join'] = await drive([join(member) for member in joins], rate)
+    while bot.joins.pending:
+        await asyncio.sleep(bot.joins.window)
+    await asyncio.sleep(bot.joins.window)
+    results['join_check'] = summarise(checks, sum(checks))
+
+    return results
+
+# compare a run with the baseline, returning the lines for anything that got worse by more than the tolerance - latencies also have to be worse by at least min_ms, as tiny ones are noisy
+def compare(results, baseline, tolerance, min_ms=0.5):
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        if base['throughput'] and result['throughput'] < base['throughput'] * (1. - tolerance):
+            regressions.append('{}: throughput {:.0f}/s, was {:.0f}/s'.format(name, result['throughput'], base['throughput']))
+        if base.get('p95') and result.get('p95', 0.) > max(base['p95'] * (1. + tolerance), base['p95'] + min_ms):
+            regressions.append('{}: p95 {:.2f} ms, was {:.2f} ms'.format(name, result['p95'], base['p95']))
+
+    return regressions
+
+def main():
+    parser = ArgumentParser(description='Benchmark the bot against a fake guild.')
+    parser.add_argument('--members', type=int, default=50000)
+    parser.add_argument('--strikes', type=int, default=5000, help='strike rows to start with')
+    parser.add_argument('--games', type=int, default=100, help='game roles')
+    parser.add_argument('--count', type=int, default=2000, help='messages and joins to send')
+    parser.add_argument('--strike-count', type=int, default=200, help='strikes and de-strikes to give')
+    parser.add_argument('--rate', type=float, default=0., help='calls a second - as fast as possible one at a time if not set')
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--save', action='store_true', help='save this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='how much worse than the baseline counts as a regression')
+    parser.add_argument('--min-ms', type=float, default=0.5, help='the least increase in p95 latency that counts as a regression')
+    args = parser.parse_args()
+
+    baseline = abspath(args.baseline)
+    results = bench_router()
+
+    # the bot writes its files to the working directory, so run it somewhere else
+    cwd = getcwd()
+    chdir(mkdtemp(prefix='bench'))
+    try:
+        loop = asyncio.get_event_loop()
+        results.update(loop.run_until_complete(bench_bot(args.members, args.strikes, args.games, args.count, args.strike_count, args.rate)))
+    finally:
+        chdir(cwd)
+
+    print('{:<16}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}'.format('benchmark', 'count', 'per second', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, result in results.items():
+        if 'p50' in result:
+            print('{:<16}{:>8}{:>12.0f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(name, result['count'], result['throughput'], result['p50'], result['p95'], result['p99'], result['max']))
+
+    # runs are only comparable with the same sizes and rate
+    settings = {name: getattr(args, name) for name in ['members', 'strikes', 'games', 'count', 'strike_count', 'rate']}
+
+    if args.save:
+        with open(baseline, 'w') as f:
+            f.write(dumps({'settings': settings, 'results': results}, indent=2))
+        print('Saved the baseline to {}'.format(baseline))
+    elif isfile(baseline):
+        with open(baseline) as f:
+            saved = loads(f.read())
+
+        if saved['settings'] != settings:
+            print('The baseline in {} was run with {} - not comparing'.format(baseline, saved['settings']))
+            return
+
+        regressions = compare(results, saved['results'], args.tolerance, args.min_ms)
+        if regressions:
+            print('Regressions against {}:'.format(baseline))
+            for line in regressions:
+                print('  ' + line)
+            raise SystemExit(1)
+        else:
+            print('No regressions against {}'.format(baseline))
+
+if __name__ == '__main__':
+    main()
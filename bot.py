@@ -2,15 +2,36 @@
 
 import asyncio
 
-from aiohttp import ClientSession
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout, TCPConnector, web
+from atexit import register
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
 from configparser import ConfigParser
 from csv import reader, writer
 from datetime import datetime, timedelta
 from discord import Client, Embed, File, Game, NotFound, Streaming
-from discord.utils import find
 from functools import wraps
+from glob import glob
+from gzip import open as gzip_open
+from hashlib import sha256
+from heapq import heappop, heappush, heapify
+from hmac import HMAC, compare_digest
+from importlib.util import module_from_spec, spec_from_file_location
 from io import BytesIO
+from json import dumps, loads
+from mmap import ACCESS_READ, mmap
 from operator import itemgetter
+from os import environ, getpid, remove, replace
+from os.path import getsize, isfile
+from queue import Empty, Queue
+from random import uniform
+from shutil import copyfileobj
+from sqlite3 import connect
+from struct import Struct
+from threading import Thread
+from time import monotonic, time
+from types import MethodType
+from urllib.parse import urlencode, urlsplit
 
 # ERRORS
 
@@ -22,59 +43,1772 @@ class UsageError(Exception):
 class CommandError(Exception):
     pass
 
+# strike record changed by something else during a transaction
+class ConflictError(CommandError):
+    pass
+
+# confirmation prompt replaced by a newer one for the same member and channel
+class SupersededError(Exception):
+    pass
+
 # FILE MANAGEMENT
 
+# the header line of the strikes file
+STRIKES_HEADER = ['ID', 'Username', 'Reason #1', 'Reason #2', 'Reason #3', 'Unban date']
+
+# the format of the unban dates in the strikes file
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+
 # write the strikes to strikes.csv
-def write_strikes(strikes):
-    with open('strikes.csv', 'w', newline='', encoding='utf-8') as f:
+def write_strikes(strikes, filename='strikes.csv'):
+    # write to a temporary file and swap it in, so a crash never leaves a half-written file
+    temp = '{}.tmp'.format(filename)
+    with open(temp, 'w', newline='', encoding='utf-8') as f:
         swriter = writer(f, delimiter=',', quotechar='\'')
 
         # write out the header line
-        swriter.writerow(['ID', 'Username', 'Reason #1', 'Reason #2', 'Reason #3', 'Unban date'])
+        swriter.writerow(STRIKES_HEADER)
 
         for id in strikes:
             swriter.writerow([id] + strikes[id])
 
+    replace(temp, filename)
+
+# parse an unban date - None if there isn't one or the ban is permanent
+def parse_unban(date):
+    if date in ['', 'never']:
+        return None
+    else:
+        return datetime.strptime(date, DATE_FORMAT)
+
+# the number of strikes in a strike record
+def strike_level(record):
+    if record[2] == '':
+        return 1
+    elif record[3] == '':
+        return 2
+    else:
+        return 3
+
+# the strikes, loaded once and kept in memory
+class StrikeStore:
+    def __init__(self, filename='strikes.csv'):
+        self.filename = filename
+
+        # records by user ID - [username, reason #1, reason #2, reason #3, unban date]
+        self.records = {}
+
+        # user IDs by strike level and by unban date
+        self.levels = {1: set(), 2: set(), 3: set()}
+        self.unbans = {}
+
+        # how many times each record has changed, to catch conflicting changes
+        self.versions = Counter()
+
+        self.load()
+
+    # read the strikes in from the file
+    def load(self):
+        self.records = {}
+        self.levels = {1: set(), 2: set(), 3: set()}
+        self.unbans = {}
+
+        try:
+            with open(self.filename, 'r', newline='', encoding='utf-8') as f:
+                sreader = reader(f, delimiter=',', quotechar='\'')
+
+                # skip the header line
+                next(sreader, None)
+
+                for line in sreader:
+                    if line:
+                        # pad out short lines so every record has all of its columns
+                        self.add(line[0], (line[1:] + [''] * 5)[:5])
+        except FileNotFoundError:
+            # file not found
+            log('Strikes file is empty - making one')
+            self.save()
+
+    # write the strikes out to the file
+    def save(self):
+        write_strikes(self.records, self.filename)
+
+    # add a record to the indexes
+    def add(self, sid, record):
+        self.records[sid] = record
+        self.levels[strike_level(record)].add(sid)
+
+        date = parse_unban(record[4])
+        if date:
+            self.unbans.setdefault(date, set()).add(sid)
+
+    # remove a record from the indexes
+    def remove(self, sid):
+        record = self.records.pop(sid)
+        self.levels[strike_level(record)].discard(sid)
+
+        date = parse_unban(record[4])
+        if date:
+            self.unbans[date].discard(sid)
+            if not self.unbans[date]:
+                self.unbans.pop(date)
+
+        return record
+
+    # set a batch of records, only writing the file if something changed
+    def update(self, records):
+        changed = False
+        for sid, record in records.items():
+            record = [str(field) for field in record]
+            if self.records.get(sid) != record:
+                if sid in self.records:
+                    self.remove(sid)
+                self.add(sid, record)
+                self.versions[sid] += 1
+                changed = True
+
+        if changed:
+            self.save()
+
+        return changed
+
+    # remove a record, writing the file if it existed
+    def pop(self, sid, default=None):
+        if sid in self.records:
+            record = self.remove(sid)
+            self.versions[sid] += 1
+            self.save()
+            return record
+        else:
+            return default
+
+    # user IDs with a given number of strikes
+    def with_level(self, level):
+        return list(self.levels[level])
+
+    # user IDs whose unban date is before a given time
+    def due(self, now):
+        return [sid for date in self.unbans if date <= now for sid in self.unbans[date]]
+
+    # the strikes file, for sending out
+    def export(self):
+        return self.filename
+
+    def __contains__(self, sid):
+        return sid in self.records
+
+    # records are copied out so changes have to go back through the store
+    def __getitem__(self, sid):
+        return list(self.records[sid])
+
+    def __setitem__(self, sid, record):
+        self.update({sid: record})
+
+    def __delitem__(self, sid):
+        if self.pop(sid) is None:
+            raise KeyError(sid)
+
+    def __iter__(self):
+        return iter(list(self.records))
+
+    def __len__(self):
+        return len(self.records)
+
+    def items(self):
+        return [(sid, list(record)) for sid, record in self.records.items()]
+
+# the strikes, kept in an SQLite database
+class SQLiteStrikeStore:
+    def __init__(self, filename='strikes.db', csv_filename='strikes.csv', export_filename='strikes-export.csv'):
+        self.filename = filename
+        self.csv_filename = csv_filename
+
+        # exports go to their own file so they're never mistaken for the strikes file to import
+        self.export_filename = export_filename
+
+        # how many times each record has changed, to catch conflicting changes
+        self.versions = Counter()
+
+        self.db = connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS strikes (id TEXT PRIMARY KEY, username TEXT, reason1 TEXT, reason2 TEXT, reason3 TEXT, unban TEXT, level INTEGER, unban_at TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS strikes_level ON strikes (level)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS strikes_unban_at ON strikes (unban_at)')
+
+        # bring over the strikes file the first time the database is used - the user version records that it's been done
+        if self.db.execute('PRAGMA user_version').fetchone()[0] == 0:
+            if len(self) == 0 and isfile(csv_filename):
+                self.import_csv(csv_filename)
+            self.db.execute('PRAGMA user_version = 1')
+
+    # the columns of a strike record - unban_at is only set for bans that expire
+    def row(self, sid, record):
+        date = parse_unban(record[4])
+        return [sid] + record + [strike_level(record), date.strftime(DATE_FORMAT) if date else None]
+
+    # read in a strikes file written by write_strikes
+    def import_csv(self, filename):
+        with open(filename, 'r', newline='', encoding='utf-8') as f:
+            sreader = reader(f, delimiter=',', quotechar='\'')
+
+            # skip the header line
+            next(sreader, None)
+
+            rows = [self.row(line[0], (line[1:] + [''] * 5)[:5]) for line in sreader if line]
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO strikes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        log('Imported {} strikes from {}'.format(len(rows), filename))
+
+    # write the strikes file out and return its name
+    def export(self):
+        write_strikes(dict(self.items()), self.export_filename)
+        return self.export_filename
+
+    # set a batch of records in one transaction, only writing if something changed
+    def update(self, records):
+        changed = False
+        with self.db:
+            for sid, record in records.items():
+                record = [str(field) for field in record]
+                if sid not in self or self[sid] != record:
+                    self.db.execute('INSERT OR REPLACE INTO strikes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self.row(sid, record))
+                    self.versions[sid] += 1
+                    changed = True
+
+        return changed
+
+    # remove a record
+    def pop(self, sid, default=None):
+        if sid in self:
+            record = self[sid]
+            with self.db:
+                self.db.execute('DELETE FROM strikes WHERE id = ?', (sid,))
+            self.versions[sid] += 1
+            return record
+        else:
+            return default
+
+    # user IDs with a given number of strikes
+    def with_level(self, level):
+        return [row[0] for row in self.db.execute('SELECT id FROM strikes WHERE level = ?', (level,))]
+
+    # user IDs whose unban date is before a given time
+    def due(self, now):
+        return [row[0] for row in self.db.execute('SELECT id FROM strikes WHERE unban_at <= ?', (now.strftime(DATE_FORMAT),))]
+
+    def __contains__(self, sid):
+        return self.db.execute('SELECT 1 FROM strikes WHERE id = ?', (sid,)).fetchone() is not None
+
+    def __getitem__(self, sid):
+        row = self.db.execute('SELECT username, reason1, reason2, reason3, unban FROM strikes WHERE id = ?', (sid,)).fetchone()
+        if row is None:
+            raise KeyError(sid)
+        else:
+            return list(row)
+
+    def __setitem__(self, sid, record):
+        self.update({sid: record})
+
+    def __delitem__(self, sid):
+        if self.pop(sid) is None:
+            raise KeyError(sid)
+
+    def __iter__(self):
+        return iter([row[0] for row in self.db.execute('SELECT id FROM strikes')])
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM strikes').fetchone()[0]
+
+    def items(self):
+        return [(row[0], list(row[1:])) for row in self.db.execute('SELECT id, username, reason1, reason2, reason3, unban FROM strikes')]
+
+# a lock for each key, dropped once nothing is holding or waiting on it
+class KeyedLock:
+    def __init__(self):
+        # key -> [lock, number of users]
+        self.locks = {}
+
+    # the lock for a key, to use with "async with"
+    def __call__(self, key):
+        return KeyedLockContext(self, key)
+
+    # check if a key's lock is held
+    def locked(self, key):
+        return key in self.locks and self.locks[key][0].locked()
+
+    async def acquire(self, key):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.release(key, False)
+            raise
+
+    def release(self, key, held=True):
+        entry = self.locks[key]
+        if held:
+            entry[0].release()
+
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.locks.pop(key)
+
+class KeyedLockContext:
+    def __init__(self, locks, key):
+        self.locks = locks
+        self.key = key
+
+    async def __aenter__(self):
+        await self.locks.acquire(self.key)
+
+    async def __aexit__(self, *args):
+        self.locks.release(self.key)
+
+# a change to one user's strike record made while holding their lock - set record to None to remove it
+class StrikeTransaction:
+    def __init__(self, store, locks, sid):
+        self.store = store
+        self.locks = locks
+        self.sid = sid
+
+    async def __aenter__(self):
+        await self.locks.acquire(self.sid)
+
+        self.version = self.store.versions[self.sid]
+        self.record = self.store[self.sid] if self.sid in self.store else None
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.locks.release(self.sid)
+
+    # write the record back, unless something else changed it first
+    def commit(self):
+        if self.store.versions[self.sid] != self.version:
+            log('Conflicting change to the strikes of user {}'.format(self.sid))
+            raise ConflictError('The strikes of user {} were changed by something else while this was running, so nothing was saved. Check "strikes" and try again.'.format(self.sid))
+
+        if self.record is None:
+            self.store.pop(self.sid)
+        else:
+            self.store[self.sid] = self.record
+
+# open the strikes with the storage set in the config file
+def open_strikes(config):
+    if config.get('strikes', 'backend', fallback='csv') == 'sqlite':
+        return SQLiteStrikeStore(config.get('strikes', 'database', fallback='strikes.db'),
+                                 export_filename=config.get('strikes', 'export', fallback='strikes-export.csv'))
+    else:
+        return StrikeStore()
+
 # UTILITY
 
+# writes log lines to the console and log files on a background thread
+class LogWriter:
+    def __init__(self, filename='out.log', json_filename=None, max_bytes=0, rotate='', backups=10, compress=True, flush_interval=1.):
+        self.filename = filename
+
+        # structured output, one JSON object per line
+        self.json_filename = json_filename
+
+        # rotate once the log is over a size, or at the start of each 'hourly' or 'daily' period
+        self.max_bytes = max_bytes
+        self.rotate = rotate
+        self.backups = backups
+        self.compress = compress
+
+        # how long to gather lines before writing them
+        self.flush_interval = flush_interval
+
+        self.queue = Queue()
+        self.period = self.current_period()
+
+        self.thread = Thread(target=self.run, name='log writer', daemon=True)
+        self.thread.start()
+
+    # queue a line to be written
+    def write(self, time, message):
+        self.queue.put((time, message))
+
+    # write everything that's queued and stop the thread
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    # the rotation period that's going on now
+    def current_period(self):
+        return datetime.now().strftime({'hourly': '%Y%m%d%H', 'daily': '%Y%m%d'}.get(self.rotate, ''))
+
+    # write out the queued lines in batches
+    def run(self):
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except Empty:
+                continue
+
+            # gather up everything else that's waiting
+            try:
+                while len(batch) < 1000:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            if None in batch:
+                running = False
+                batch = [line for line in batch if line is not None]
+
+            try:
+                self.flush(batch)
+            except Exception as ex:
+                print('Unhandled {} while writing the log: {}'.format(ex.__class__.__name__, ex))
+
+    # write a batch of lines
+    def flush(self, batch):
+        if not batch:
+            return
+
+        if self.needs_rotating():
+            self.rotate_files()
+
+        lines = ['[{}]: {}'.format(time.strftime('%Y-%m-%d %H:%M'), message) for time, message in batch]
+        print('\n'.join(lines))
+
+        with open(self.filename, 'a') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+        if self.json_filename:
+            with open(self.json_filename, 'a') as f:
+                f.write(''.join(dumps({'time': time.isoformat(), 'message': str(message)}) + '\n' for time, message in batch))
+
+    # check if the log has got too big or its period has finished
+    def needs_rotating(self):
+        if self.max_bytes and isfile(self.filename) and getsize(self.filename) >= self.max_bytes:
+            return True
+        else:
+            return self.current_period() != self.period
+
+    # move the log files out of the way, compressing them and removing old ones
+    def rotate_files(self):
+        self.period = self.current_period()
+        # down to the microsecond, as a burst of logging can fill the file more than once a second
+        suffix = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+        for filename in [self.filename, self.json_filename]:
+            if not filename or not isfile(filename):
+                continue
+
+            rotated = '{}.{}'.format(filename, suffix)
+            replace(filename, rotated)
+
+            if self.compress:
+                with open(rotated, 'rb') as f_in, gzip_open(rotated + '.gz', 'wb') as f_out:
+                    copyfileobj(f_in, f_out)
+                remove(rotated)
+
+            # only keep the newest backups - matching just the rotated names, as the other log can share this one's name
+            for old in sorted(glob('{}.{}-*'.format(filename, '[0-9]' * 8)))[:-self.backups]:
+                remove(old)
+
+# the log writer, made when it's first needed
+log_writer = None
+
+# set up the log writer from the config file
+def start_logging(config):
+    global log_writer
+
+    if log_writer is not None:
+        log_writer.stop()
+
+    log_writer = LogWriter(config.get('logging', 'file', fallback='out.log'),
+                           config.get('logging', 'json', fallback='') or None,
+                           config.getint('logging', 'max_bytes', fallback=0),
+                           config.get('logging', 'rotate', fallback=''),
+                           config.getint('logging', 'backups', fallback=10),
+                           config.getboolean('logging', 'compress', fallback=True))
+
+# write anything left in the log when the bot exits
+@register
+def stop_logging():
+    if log_writer is not None:
+        log_writer.stop()
+
 # log to file and console
 def log(message):
-    ts = datetime.now().strftime('%Y-%m-%d %H:%M') 
-    print('[{0}]: {1}'.format(ts, message))
-    with open('out.log', 'a') as f:
-        f.write('[{}]: {}\n'.format(ts, message))
+    global log_writer
 
-# edit a member's roles
-async def edit_roles(member, add=[], remove=[]):
-    # get the list of the member's current roles
-    roles = member.roles
+    if log_writer is None:
+        log_writer = LogWriter()
 
-    # remove the desired roles from the list
-    for role in remove:
-        if role in roles:
-            roles.remove(role)
+    log_writer.write(datetime.now(), message)
 
-    # add the desired roles from the list
-    for role in add:
-        if role not in roles:
-            roles.append(role)
+# the number of members with each role, kept up to date from member events
+class RoleCounter:
+    def __init__(self):
+        # role ID -> member count
+        self.counts = Counter()
+
+        # set when a member event was dropped, so the counts are known to be wrong
+        self.dirty = False
+
+    # count every member's roles
+    def build(self, members):
+        self.counts = self.scan(members)
+        self.dirty = False
+
+    # count the roles with a full scan
+    def scan(self, members):
+        counts = Counter()
+        for member in members:
+            counts.update(role.id for role in member.roles)
+
+        return counts
+
+    # a member with these roles has joined
+    def add(self, roles):
+        self.counts.update(role.id for role in roles)
+
+    # a member with these roles has left
+    def remove(self, roles):
+        self.counts.subtract(role.id for role in roles)
+
+    # a member's roles have changed
+    def change(self, before, after):
+        before = {role.id for role in before}
+        after = {role.id for role in after}
+
+        self.counts.update(after - before)
+        self.counts.subtract(before - after)
+
+    # the number of members with a role
+    def get(self, role):
+        return self.counts[role.id]
+
+    # a change was missed, so the counts need a full scan
+    def mark_dirty(self):
+        self.dirty = True
+
+    # compare the counts with a full scan and fix them, returning role ID -> (counted, actual) for any that were wrong
+    def reconcile(self, members):
+        actual = self.scan(members)
+        drift = {rid: (self.counts[rid], actual[rid]) for rid in set(self.counts) | set(actual) if self.counts[rid] != actual[rid]}
+        self.counts = actual
+        self.dirty = False
+
+        return drift
+
+# read the state saved by the last run - None if there isn't one for this guild or it's too old
+def read_snapshot(filename, guild, max_age):
+    if not filename or not isfile(filename):
+        return None
+
+    try:
+        with open(filename, encoding='utf-8') as f:
+            snapshot = loads(f.read())
+    except (OSError, ValueError) as ex:
+        log('Couldn\'t read the snapshot {}: {}'.format(filename, ex))
+        return None
+
+    if snapshot.get('guild') != guild or time() - snapshot.get('time', 0.) > max_age:
+        return None
+
+    return snapshot
+
+# write some JSON - the snapshot, heartbeat and session files
+def write_json(data, filename):
+    # write to a temporary file and swap it in, so a crash never leaves a half-written file
+    temp = '{}.tmp'.format(filename)
+    with open(temp, 'w', encoding='utf-8') as f:
+        f.write(dumps(data))
+
+    replace(temp, filename)
+
+# a role count sample - unix time, role ID, member count
+SAMPLE = Struct('<IQI')
+
+# role counts over time, in append-only binary files - hourly samples are downsampled to daily ones after a while
+class RoleHistory:
+    def __init__(self, filename='rolestats.bin', daily_filename='rolestats_daily.bin', keep_days=30):
+        self.filename = filename
+        self.daily_filename = daily_filename
+        self.keep_days = keep_days
+
+    # add a sample of each role's count
+    def append(self, time, counts, filename=None):
+        ts = int(time.timestamp())
+        with open(filename or self.filename, 'ab') as f:
+            f.write(b''.join(SAMPLE.pack(ts, rid, count) for rid, count in counts.items()))
+
+    # the index of the first sample at or after a time
+    def find(self, buffer, ts):
+        low, high = 0, len(buffer) // SAMPLE.size
+        while low < high:
+            middle = (low + high) // 2
+            if SAMPLE.unpack_from(buffer, middle * SAMPLE.size)[0] < ts:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    # the samples in a file between two unix times, read through a memory map
+    def samples(self, filename, start, end):
+        if not isfile(filename) or getsize(filename) < SAMPLE.size:
+            return
+
+        with open(filename, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as buffer:
+            for i in range(self.find(buffer, start), len(buffer) // SAMPLE.size):
+                sample = SAMPLE.unpack_from(buffer, i * SAMPLE.size)
+                if sample[0] > end:
+                    break
+                yield sample
+
+    # the first and last count of each role between two times, with its lowest and highest counts
+    def trends(self, start, end, role_ids=None):
+        start, end = int(start.timestamp()), int(end.timestamp())
+
+        trends = {}
+        for filename in [self.daily_filename, self.filename]:
+            for ts, rid, count in self.samples(filename, start, end):
+                if role_ids is not None and rid not in role_ids:
+                    continue
+
+                if rid in trends:
+                    trend = trends[rid]
+                    trend['last'] = (ts, count)
+                    trend['min'] = min(trend['min'], count)
+                    trend['max'] = max(trend['max'], count)
+                else:
+                    trends[rid] = {'first': (ts, count), 'last': (ts, count), 'min': count, 'max': count}
+
+        return trends
+
+    # average the hourly samples older than keep_days into daily ones
+    def downsample(self, now):
+        cutoff = datetime(now.year, now.month, now.day) - timedelta(days=self.keep_days)
+        cutoff_ts = int(cutoff.timestamp())
+
+        if not isfile(self.filename) or getsize(self.filename) < SAMPLE.size:
+            return 0
+
+        with open(self.filename, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as buffer:
+            split = self.find(buffer, cutoff_ts)
+            if split == 0:
+                return 0
+
+            # average each role's samples for each day
+            days = OrderedDict()
+            for i in range(split):
+                ts, rid, count = SAMPLE.unpack_from(buffer, i * SAMPLE.size)
+                day = datetime.fromtimestamp(ts)
+                days.setdefault((datetime(day.year, day.month, day.day), rid), []).append(count)
+
+            with open(self.daily_filename, 'ab') as daily:
+                daily.write(b''.join(SAMPLE.pack(int(day.timestamp()), rid, round(sum(counts) / len(counts))) for (day, rid), counts in days.items()))
+
+            # keep the newer hourly samples
+            temp = '{}.tmp'.format(self.filename)
+            with open(temp, 'wb') as hourly:
+                hourly.write(buffer[split * SAMPLE.size:])
+
+        replace(temp, self.filename)
+        return split
+
+# the confirmation prompts waiting on a reply by (channel ID, member ID), timed out by a timer wheel
+class ConfirmationRegistry:
+    def __init__(self, slots=60, tick=1.):
+        # (channel ID, member ID) -> future waiting on the reply
+        self.waiting = {}
+
+        # each slot holds key -> full turns of the wheel left before it times out
+        self.wheel = [{} for _ in range(slots)]
+        self.slots = {}
+        self.position = 0
+        self.tick_length = tick
+
+    # wait for a member's next message in a channel
+    def wait(self, channel, member, timeout=60.):
+        key = (channel.id, member.id)
+
+        # a new prompt replaces any older one for the same member and channel
+        if key in self.waiting:
+            future = self.remove(key)
+            if not future.done():
+                future.set_exception(SupersededError())
+
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[key] = future
+
+        ticks = max(1, int(round(timeout / self.tick_length)))
+        slot = (self.position + ticks) % len(self.wheel)
+        self.wheel[slot][key] = (ticks - 1) // len(self.wheel)
+        self.slots[key] = slot
+
+        return future
+
+    # stop waiting on a key
+    def remove(self, key):
+        self.wheel[self.slots.pop(key)].pop(key)
+        return self.waiting.pop(key)
+
+    # time out a key's prompt if there is one
+    def expire(self, key):
+        if key in self.waiting:
+            future = self.remove(key)
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError())
+
+    # pass a message to the prompt waiting on it, returning True if there was one
+    def resolve(self, message):
+        key = (message.channel.id, message.author.id)
+
+        if key in self.waiting:
+            future = self.remove(key)
+            if not future.done():
+                future.set_result(message)
+            return True
+        else:
+            return False
+
+    # move the wheel on a slot, timing out the prompts that are due
+    def tick(self):
+        self.position = (self.position + 1) % len(self.wheel)
+        slot = self.wheel[self.position]
+
+        for key, turns in list(slot.items()):
+            if turns > 0:
+                slot[key] = turns - 1
+            else:
+                self.expire(key)
+
+    def __len__(self):
+        return len(self.waiting)
+
+# a token bucket - allows bursts of up to capacity, refilling at rate tokens per second
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.time = monotonic()
+
+    # top up the tokens for the time that's passed
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    # take a token if there is one
+    def take(self):
+        self.refill()
+        if self.tokens >= 1.:
+            self.tokens -= 1.
+            return True
+        else:
+            return False
+
+    # check if the bucket has filled back up
+    def full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+# token buckets by key, forgetting the least recently used and any left idle until they refill
+class RateLimiter:
+    def __init__(self, size=10000, idle=600.):
+        self.size = size
+        self.idle = idle
+
+        # key -> token bucket, least recently used first
+        self.buckets = OrderedDict()
+
+        # the keys which have been told to slow down since they were last allowed
+        self.warned = set()
+
+    # take a token from a key's bucket, returning whether it was allowed
+    def allow(self, key, count, per):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(count / per, count)
+        else:
+            self.buckets.move_to_end(key)
+
+        self.evict()
+
+        if bucket.take():
+            self.warned.discard(key)
+            return True
+        else:
+            return False
+
+    # check if a throttled key should be told to slow down - only once until it's allowed again
+    def warn(self, key):
+        if key in self.warned:
+            return False
+        else:
+            self.warned.add(key)
+            return True
+
+    # drop buckets when there are too many, or they've been idle long enough to refill
+    def evict(self):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) > self.size or (monotonic() - bucket.time > self.idle and bucket.full()):
+                self.buckets.popitem(last=False)
+                self.warned.discard(key)
+            else:
+                break
+
+    def __len__(self):
+        return len(self.buckets)
+
+# a bounded queue of events of one type, handled by a fixed number of workers
+class EventQueue:
+    def __init__(self, handler, workers=4, size=1000, overflow='drop_oldest', key=None, merge=None, on_drop=None):
+        # runs an event's (args, kwargs)
+        self.handler = handler
+        self.workers = workers
+
+        # when full, 'drop_oldest' makes room for new events and 'drop_newest' turns them away - on_drop is called for each one lost
+        self.size = size
+        self.overflow = overflow
+        self.on_drop = on_drop
+
+        # events with the same key are coalesced while queued - merge combines the queued and new args, otherwise the new ones win
+        self.key = key
+        self.merge = merge
+
+        # [key, args, kwargs] entries, oldest first
+        self.items = deque()
+        self.keys = {}
+        self.available = asyncio.Semaphore(0)
+        self.tasks = []
+
+        # bumped on stop, so workers finishing a cancelled handler know to exit
+        self.generation = 0
+
+        self.stats = {'queued': 0, 'processed': 0, 'dropped': 0, 'coalesced': 0, 'max_depth': 0}
+
+    # queue an event, starting the workers the first time
+    def put(self, args, kwargs):
+        if not self.tasks:
+            self.tasks = [asyncio.ensure_future(self.work(self.generation)) for _ in range(self.workers)]
+
+        key = self.key(*args, **kwargs) if self.key is not None else None
+        if key is not None and key in self.keys:
+            item = self.keys[key]
+            item[1] = self.merge(item[1], args) if self.merge is not None else args
+            item[2] = kwargs
+            self.stats['coalesced'] += 1
+            return
+
+        if len(self.items) >= self.size:
+            self.stats['dropped'] += 1
+            if self.on_drop is not None:
+                self.on_drop()
+            if self.overflow == 'drop_newest':
+                return
+            else:
+                dropped = self.items.popleft()
+                self.keys.pop(dropped[0], None)
+        else:
+            self.available.release()
+
+        item = [key, args, kwargs]
+        self.items.append(item)
+        if key is not None:
+            self.keys[key] = item
+
+        self.stats['queued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self.items))
+
+    # handle events until stopped - handlers swallow cancellation, so check the generation after each one
+    async def work(self, generation):
+        while generation == self.generation:
+            await self.available.acquire()
+            key, args, kwargs = self.items.popleft()
+            if key is not None:
+                self.keys.pop(key, None)
+
+            await self.handler(*args, **kwargs)
+            self.stats['processed'] += 1
+
+    # stop the workers
+    def stop(self):
+        self.generation += 1
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def __len__(self):
+        return len(self.items)
+
+# the upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+# counts of values in fixed buckets, cheap enough to record everything
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+
+        # the count in each bucket, with one more for anything past the last
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # estimate a percentile by assuming values are spread evenly within their bucket
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.
+
+        rank = p / 100. * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[i - 1] if i > 0 else 0.
+                high = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, low + (high - low) * (rank - seen) / count)
+            seen += count
+
+        return self.max
+
+# counters and histograms by name and labels, which can be shown in the Prometheus text format
+class Metrics:
+    def __init__(self):
+        # (name, labels) -> value or histogram, where labels is a tuple of (label, value) pairs
+        self.counters = {}
+        self.histograms = {}
+
+        # name -> function giving {labels: value} for values worked out when asked for
+        self.gauges = {}
+
+        # name -> help text
+        self.help = {}
+
+    # add to a counter
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    # record a value in a histogram
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    # add a gauge
+    def gauge(self, name, values, help=''):
+        self.gauges[name] = values
+        self.help[name] = help
+
+    # time a block of code into a histogram, counting the results
+    def timer(self, name, **labels):
+        return MetricsTimer(self, name, labels)
+
+    # the histograms with a name, by the value of one of their labels
+    def histograms_by(self, name, label):
+        return {dict(labels).get(label): histogram for (n, labels), histogram in self.histograms.items() if n == name}
+
+    # the counters with a name, by the values of two of their labels
+    def counters_by(self, name, label, other):
+        counts = {}
+        for (n, labels), value in self.counters.items():
+            if n == name:
+                labels = dict(labels)
+                counts.setdefault(labels.get(label), Counter())[labels.get(other)] += value
+
+        return counts
+
+    # everything in the Prometheus text format
+    def render(self):
+        def labels_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            return '{{{}}}'.format(','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)) if labels else ''
+
+        lines = []
+        for name in sorted({n for n, _ in self.counters}):
+            lines.append('# TYPE {} counter'.format(name))
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append('{}{} {}'.format(name, labels_text(labels), value))
+
+        for name in sorted({n for n, _ in self.histograms}):
+            lines.append('# TYPE {} histogram'.format(name))
+            for (n, labels), histogram in sorted(self.histograms.items(), key=itemgetter(0)):
+                if n == name:
+                    total = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        total += count
+                        lines.append('{}_bucket{} {}'.format(name, labels_text(labels, [('le', bound)]), total))
+                    lines.append('{}_sum{} {}'.format(name, labels_text(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(name, labels_text(labels), histogram.count))
+
+        for name, values in sorted(self.gauges.items()):
+            if self.help[name]:
+                lines.append('# HELP {} {}'.format(name, self.help[name]))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in sorted(values().items()):
+                lines.append('{}{} {}'.format(name, labels_text(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+# times a block of code into a histogram and counts whether it worked
+class MetricsTimer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+        # can be changed before the block ends, otherwise it's set from whether there was an exception
+        self.result = None
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.metrics.observe('{}_seconds'.format(self.name), monotonic() - self.start, **self.labels)
+        if self.result is None:
+            self.result = 'ok' if kind is None else 'cancelled' if kind is asyncio.CancelledError else 'error'
+        self.metrics.inc('{}_total'.format(self.name), result=self.result, **self.labels)
+
+# serves the metrics for Prometheus to scrape
+class MetricsServer:
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+        self.app = web.Application()
+        self.app.router.add_get('/metrics', self.serve)
+        self.runner = None
+
+    # start listening
+    async def start(self, host, port):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    # stop listening
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def serve(self, request):
+        return web.Response(text=self.metrics.render(), content_type='text/plain', charset='utf-8')
+
+# groups up errors and sends them to a channel as summaries, within a rate limit
+class ErrorReporter:
+    def __init__(self, send, window=60., rate=1 / 30., burst=5):
+        # sends a summary to the channel
+        self.send = send
+
+        # how long to gather errors before sending a summary
+        self.window = window
+
+        # the channel's outbound rate limit
+        self.bucket = TokenBucket(rate, burst)
+
+        # (location, exception type, message) -> [count, first seen, last seen]
+        self.groups = OrderedDict()
+
+    # record an error - critical errors are sent straight away if the rate limit allows
+    async def report(self, location, ex, critical=False):
+        if critical and self.bucket.take():
+            await self.send('Unhandled {} {}: {}'.format(ex.__class__.__name__, location, ex))
+        else:
+            key = (location, ex.__class__.__name__, str(ex))
+            now = datetime.now()
+            if key in self.groups:
+                self.groups[key][0] += 1
+                self.groups[key][2] = now
+            else:
+                self.groups[key] = [1, now, now]
+
+    # send a summary of the errors since the last one
+    async def flush(self):
+        if not self.groups or not self.bucket.take():
+            return False
+
+        lines = []
+        for (location, name, message), (count, first, last) in self.groups.items():
+            if count == 1:
+                lines.append('Unhandled {} {}: {} ({})'.format(name, location, message, first.strftime('%H:%M:%S')))
+            else:
+                lines.append('**{}x** unhandled {} {}: {} ({} to {})'.format(count, name, location, message, first.strftime('%H:%M:%S'), last.strftime('%H:%M:%S')))
+        self.groups.clear()
+
+        # keep inside the embed description limit
+        summary = ''
+        for i, line in enumerate(lines):
+            if len(summary) + len(line) > 1900:
+                summary += '...and {} more.'.format(len(lines) - i)
+                break
+            summary += line + '\n'
+
+        await self.send(summary)
+        return True
+
+# usernames by user ID, expiring after a time and evicting the least recently used
+class UserCache:
+    def __init__(self, ttl=3600., size=10000):
+        self.ttl = ttl
+        self.size = size
+
+        # user ID -> (expiry time, username)
+        self.users = OrderedDict()
+
+    # get a cached username - None if it isn't cached or has expired
+    def get(self, uid):
+        entry = self.users.get(uid)
+
+        if entry is None:
+            return None
+        elif entry[0] < monotonic():
+            # expired
+            self.users.pop(uid)
+            return None
+        else:
+            self.users.move_to_end(uid)
+            return entry[1]
+
+    # cache a username
+    def set(self, uid, name):
+        self.users[uid] = (monotonic() + self.ttl, name)
+        self.users.move_to_end(uid)
+
+        # evict the least recently used usernames
+        while len(self.users) > self.size:
+            self.users.popitem(last=False)
+
+    def __len__(self):
+        return len(self.users)
+
+# the pending unbans, kept in a heap with the soonest first
+class UnbanScheduler:
+    def __init__(self):
+        # (unban date, user ID) entries - rescheduled or cancelled entries are left in and skipped
+        self.heap = []
 
-    # edit the member's roles
-    await member.edit(roles=roles)
+        # the live unban date for each user ID
+        self.dates = {}
+
+        # set whenever the schedule changes, to wake up the waiting process
+        self.changed = asyncio.Event()
+
+    # schedule an unban, replacing any existing one - a date of None cancels it
+    def schedule(self, sid, date):
+        if date is None:
+            return self.cancel(sid)
+
+        self.dates[sid] = date
+        heappush(self.heap, (date, sid))
+
+        # drop the skipped entries once they take up most of the heap
+        if len(self.heap) > 2 * len(self.dates) + 64:
+            self.heap = [(date, sid) for sid, date in self.dates.items()]
+            heapify(self.heap)
+
+        self.changed.set()
+
+    # cancel an unban
+    def cancel(self, sid):
+        if self.dates.pop(sid, None) is not None:
+            self.changed.set()
+
+    # the next unban date - None if nothing is scheduled
+    def next(self):
+        while self.heap:
+            date, sid = self.heap[0]
+            if self.dates.get(sid) == date:
+                return date
+            else:
+                heappop(self.heap)
+
+        return None
+
+    # take the (user ID, unban date) pairs which are due off the schedule
+    def pop_due(self, now):
+        due = []
+
+        date = self.next()
+        while date is not None and date <= now:
+            date, sid = heappop(self.heap)
+            self.dates.pop(sid)
+            due.append((sid, date))
+
+            date = self.next()
+
+        return due
+
+    # sleep until the next unban is due or the schedule changes
+    async def wait(self):
+        self.changed.clear()
+
+        date = self.next()
+        timeout = None if date is None else max(0., (date - datetime.now()).total_seconds())
+
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def __len__(self):
+        return len(self.dates)
+
+# a pooled HTTP client shared across the bot, with retries and request timings
+class WebClient:
+    def __init__(self, session=None, timeout=10., retries=3, backoff=0.5, limit=20):
+        # a session can be passed in, otherwise one is made on first use
+        self.session = session
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limit = limit
+
+        # request timings by name - count, errors, total seconds and slowest seconds
+        self.timings = {}
+
+        # also records the timings if set
+        self.metrics = None
+
+    # make the session if there isn't an open one
+    def open(self):
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(connector=TCPConnector(limit=self.limit, keepalive_timeout=60.),
+                                         timeout=ClientTimeout(total=self.timeout))
+
+        return self.session
+
+    # close the session
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    # record how long a request took
+    def record(self, name, duration, error=False):
+        timing = self.timings.setdefault(name, {'count': 0, 'errors': 0, 'total': 0., 'max': 0.})
+        timing['count'] += 1
+        timing['errors'] += int(error)
+        timing['total'] += duration
+        timing['max'] = max(timing['max'], duration)
+
+        if self.metrics is not None:
+            self.metrics.observe('bot_http_request_seconds', duration, api=name)
+            self.metrics.inc('bot_http_requests_total', api=name, result='error' if error else 'ok')
+
+    # request some JSON, retrying server errors and timeouts with exponential backoff and jitter
+    async def get_json(self, url, name=None, **kwargs):
+        name = name or urlsplit(url).netloc
+        session = self.open()
+
+        for attempt in range(self.retries + 1):
+            start = monotonic()
+            try:
+                async with session.get(url, **kwargs) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json(content_type=None)
+
+                self.record(name, monotonic() - start)
+                return data
+            except (ClientError, asyncio.TimeoutError) as ex:
+                self.record(name, monotonic() - start, True)
+
+                # only retry if the request might work next time
+                if attempt == self.retries or (isinstance(ex, ClientResponseError) and ex.status < 500 and ex.status != 429):
+                    raise
+
+                await asyncio.sleep(uniform(0., self.backoff * 2 ** attempt))
+
+    # the timings with the average worked out
+    def stats(self):
+        return {name: dict(timing, mean=timing['total'] / timing['count']) for name, timing in self.timings.items()}
+
+# the days of the week, as used in the stream times
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# read expected stream times like "wed 18:00-22:00 sat 12:00-16:00" into (weekday, start minute, end minute)
+def parse_stream_times(text):
+    tokens = text.lower().split()
+    times = []
+    for day, hours in zip(tokens[::2], tokens[1::2]):
+        start, end = [int(t.split(':')[0]) * 60 + int(t.split(':')[1]) for t in hours.split('-')]
+        times.append((WEEKDAYS.index(day[:3]), start, end))
+
+    return times
+
+# watches a list of Twitch channels for streams going live
+class StreamMonitor:
+    def __init__(self, web, url, channels, times=[], period=60., fast=20., slow=600., idle=3600., lead=15):
+        self.web = web
+
+        # builds the API URL for a batch of channels
+        self.url = url
+
+        # the live stream of each channel - False if offline, None before the first check
+        self.channels = [channel.lower() for channel in channels]
+        self.live = {channel: None for channel in self.channels}
+
+        # the poll intervals - fast around the expected stream times, slow once everything has been offline for a while
+        self.times = times
+        self.period = period
+        self.fast = fast
+        self.slow = slow
+        self.idle = idle
+        self.lead = lead
+
+        self.last_live = monotonic()
+        self.backoff = period
+
+    # check the channels, returning the streams which have just gone live
+    async def poll(self, batch=100):
+        streams = {}
+        for i in range(0, len(self.channels), batch):
+            info = await self.web.get_json(self.url(self.channels[i:i + batch]), 'twitch')
+            for stream in info['streams']:
+                streams[stream['channel']['name'].lower()] = stream
+
+        return [streams[channel] for channel in self.channels if self.update(channel, streams.get(channel, False))]
+
+    # look up a single channel's stream - False if it's offline
+    async def fetch(self, channel):
+        info = await self.web.get_json(self.url([channel]), 'twitch')
+        return info['streams'][0] if info['streams'] else False
+
+    # set a channel's stream, returning True if it has just gone live
+    def update(self, channel, stream, pushed=False):
+        # polls only announce streams which were seen going live, pushed notifications are always a change
+        went_live = bool(stream) and (not self.live[channel] if pushed else self.live[channel] is False)
+        self.live[channel] = stream
+
+        return went_live
+
+    # the first live stream, in the order the channels were given
+    def current(self):
+        for channel in self.channels:
+            if self.live[channel]:
+                return self.live[channel]
+
+        return None
+
+    # check if a stream is expected around a given time
+    def expected(self, now):
+        minute = now.hour * 60 + now.minute
+        return any(now.weekday() == day and start - self.lead <= minute <= end for day, start, end in self.times)
+
+    # how long to wait before the next poll
+    def interval(self, now):
+        if self.current():
+            self.last_live = monotonic()
+
+        if self.current() or self.expected(now):
+            self.backoff = self.period
+            return self.fast
+        elif monotonic() - self.last_live < self.idle:
+            self.backoff = self.period
+            return self.period
+        else:
+            # back off while everything stays offline
+            self.backoff = min(self.backoff * 2, self.slow)
+            return self.backoff
+
+# receives pushed stream notifications from Twitch
+class StreamWebhook:
+    def __init__(self, secret, dispatch):
+        self.secret = secret.encode()
+
+        # called with (channel, stream list) for each notification
+        self.dispatch = dispatch
+
+        self.app = web.Application()
+        self.app.router.add_get('/twitch/{channel}', self.verify)
+        self.app.router.add_post('/twitch/{channel}', self.notify)
+        self.runner = None
+
+    # start listening
+    async def start(self, host, port):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    # stop listening
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    # confirm a subscription by echoing the challenge
+    async def verify(self, request):
+        if request.query.get('hub.mode') == 'denied':
+            log('Stream subscription for {} denied: {}'.format(request.match_info['channel'], request.query.get('hub.reason')))
+            return web.Response()
+        elif 'hub.challenge' in request.query:
+            log('Stream subscription for {} confirmed'.format(request.match_info['channel']))
+            return web.Response(text=request.query['hub.challenge'])
+        else:
+            return web.Response(status=400)
+
+    # handle a stream going online or offline
+    async def notify(self, request):
+        body = await request.read()
+
+        # check the notification was signed with the secret
+        signature = 'sha256=' + HMAC(self.secret, body, sha256).hexdigest()
+        if not compare_digest(request.headers.get('X-Hub-Signature', ''), signature):
+            return web.Response(status=403)
+
+        try:
+            streams = loads(body.decode('utf-8'))['data']
+        except (ValueError, KeyError):
+            return web.Response(status=400)
+
+        self.dispatch(request.match_info['channel'].lower(), streams)
+        return web.Response()
+
+# picks the bot's presence from a default and prioritised overrides, only sending changes
+class PresenceManager:
+    def __init__(self, send, window=15.):
+        # sends an activity to discord
+        self.send = send
+
+        # the shortest time between presence updates
+        self.window = window
+
+        self.default = None
+
+        # key -> (priority, activity, expiry time or None)
+        self.overrides = {}
+
+        # what was last sent, to skip updates that wouldn't change anything
+        self.last = None
+
+    # set the presence shown when there are no overrides
+    def set_default(self, activity):
+        self.default = activity
+
+    # show an activity over the default - the highest priority override wins
+    def override(self, key, activity, priority=0, duration=None):
+        self.overrides[key] = (priority, activity, None if duration is None else monotonic() + duration)
+
+    # remove an override
+    def clear(self, key):
+        self.overrides.pop(key, None)
+
+    # the activity which should be shown
+    def current(self):
+        now = monotonic()
+        for key in [key for key, (_, _, expiry) in self.overrides.items() if expiry is not None and expiry < now]:
+            self.overrides.pop(key)
+
+        if self.overrides:
+            return max(self.overrides.values(), key=itemgetter(0))[1]
+        else:
+            return self.default
+
+    # send the current activity if it has changed
+    async def flush(self):
+        activity = self.current()
+        key = (activity.__class__.__name__, getattr(activity, 'name', None), getattr(activity, 'url', None), getattr(activity, 'details', None))
+
+        if key != self.last:
+            await self.send(activity)
+            self.last = key
+            return True
+        else:
+            return False
+
+# gathers up member joins over a short window so they can be checked in one go, and spots raids
+class JoinBatcher:
+    def __init__(self, check, window=2., threshold=20, period=60., lockdown=600.):
+        # called with each batch of members and whether a lockdown just started
+        self.check = check
+        self.window = window
+
+        # this many joins within the period starts a lockdown, which lasts until there's been no joins for a while
+        self.threshold = threshold
+        self.period = period
+        self.lockdown = lockdown
+        self.until = 0.
+        self.started = False
+
+        # times of the recent joins, oldest first
+        self.joins = deque()
+
+        self.pending = []
+
+    # queue a member to be checked
+    def add(self, member):
+        now = monotonic()
+        self.joins.append(now)
+        while self.joins[0] <= now - self.period:
+            self.joins.popleft()
+
+        if len(self.joins) >= self.threshold:
+            if not self.locked():
+                self.started = True
+            self.until = now + self.lockdown
+
+        if not self.pending:
+            asyncio.ensure_future(self.flush())
+        self.pending.append(member)
+
+    # whether there's a lockdown
+    def locked(self):
+        return monotonic() < self.until
+
+    # check the queued members once the window has passed
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        members, self.pending = self.pending, []
+        started, self.started = self.started, False
+
+        await self.check(members, started)
+
+# gathers up the role changes for each member over a short window and makes them in a single edit
+class RoleQueue:
+    def __init__(self, get_member, window=0.5, concurrency=5):
+        # member ID -> the member as the gateway currently has it
+        self.get_member = get_member
+
+        self.window = window
+
+        # limits how many edits are made at once
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        # member ID -> roles to add and remove by ID, and the futures waiting on the edit
+        self.pending = {}
+
+    # queue a change to a member's roles - removals are applied before additions
+    def edit(self, member, add=[], remove=[]):
+        pending = self.pending.get(member.id)
+        if pending is None:
+            pending = self.pending[member.id] = {'add': {}, 'remove': {}, 'futures': []}
+            asyncio.ensure_future(self.flush(member.id))
+
+        # later changes override earlier ones
+        for role in remove:
+            pending['add'].pop(role.id, None)
+            pending['remove'][role.id] = role
+        for role in add:
+            pending['remove'].pop(role.id, None)
+            pending['add'][role.id] = role
+
+        future = asyncio.get_event_loop().create_future()
+        pending['futures'].append(future)
+        return future
+
+    # make a member's queued changes once the window has passed
+    async def flush(self, mid):
+        await asyncio.sleep(self.window)
+        pending = self.pending.pop(mid)
+
+        try:
+            async with self.semaphore:
+                member = self.get_member(mid)
+
+                if member is not None:
+                    # work from the member's current roles rather than editing the list it gives out
+                    current = [role for role in member.roles if not role.is_default()]
+                    roles = [role for role in current if role.id not in pending['remove'] and role.id not in pending['add']] + list(pending['add'].values())
+
+                    if {role.id for role in roles} != {role.id for role in current}:
+                        await member.edit(roles=roles)
+        except Exception as ex:
+            for future in pending['futures']:
+                if not future.done():
+                    future.set_exception(ex)
+        else:
+            for future in pending['futures']:
+                if not future.done():
+                    future.set_result(member)
+
+# a whole number which can't be negative, for command arguments
+def number(text):
+    value = int(text)
+    if value < 0:
+        raise ValueError(text)
+
+    return value
+
+# the arguments a command takes - checked, and converted with types, before the command runs
+class Args:
+    def __init__(self, min=0, max=None, types=(), mentions=None, roles=None):
+        self.min = min
+        self.max = max
+        self.types = types
+
+        # the number of user pings needed, and the least number of role pings
+        self.mentions = mentions
+        self.roles = roles
+
+    def parse(self, args, mentions, roles):
+        if self.mentions is not None and len(mentions) != self.mentions:
+            raise UsageError(' Ping {}.'.format('a single user' if self.mentions == 1 else '{} users'.format(self.mentions)))
+        elif self.roles is not None and len(roles) < self.roles:
+            raise UsageError(' Ping {}.'.format('a role' if self.roles == 1 else 'at least {} roles'.format(self.roles)))
+        elif len(args) < self.min or (self.max is not None and len(args) > self.max):
+            raise UsageError
+
+        args = list(args)
+        for i, convert in enumerate(self.types[:len(args)]):
+            try:
+                args[i] = convert(args[i])
+            except ValueError:
+                raise UsageError(' "{}" isn\'t valid.'.format(args[i]))
+
+        return args
+
+# the edit distance between two names, giving up once it's over a limit
+def edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+
+    return min(previous[-1], limit + 1)
+
+# looks up commands by name or alias, built once with everything worked out up front
+class CommandRouter:
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+        # name -> command entry
+        self.commands = OrderedDict()
+
+        # name or alias -> command entry
+        self.table = {}
+
+        # names and aliases by length, for suggestions
+        self.lengths = {}
+
+        # recent suggestions by (name, admin), as unknown commands tend to be repeated
+        self.suggestions = OrderedDict()
+
+    # add a command
+    def add(self, name, cmd, embed=None):
+        entry = {'name': name, 'cmd': cmd, 'admin_only': cmd.admin_only, 'embed': embed}
+        self.commands[name] = entry
+
+        for key in [name] + list(cmd.aliases):
+            self.table[key] = entry
+            self.lengths.setdefault(len(key), []).append(key)
+
+    # split a message into the command name and its arguments
+    def parse(self, content):
+        command, *args = content.split()
+        return self.name(command), args
+
+    # the command name in some text, without the prefix
+    def name(self, text):
+        text = text.lower()
+        return text[len(self.prefix):] if text.startswith(self.prefix) else text
+
+    # find a command by name or alias - admin-only commands need admin set
+    def find(self, name, admin=False):
+        entry = self.table.get(name)
+        return entry if entry is not None and (admin or not entry['admin_only']) else None
+
+    # the closest command name to an unknown one, if any are close enough
+    def suggest(self, name, admin=False, limit=2):
+        if (name, admin) in self.suggestions:
+            self.suggestions.move_to_end((name, admin))
+            return self.suggestions[(name, admin)]
+
+        best, best_distance = None, limit + 1
+        for length in range(len(name) - limit, len(name) + limit + 1):
+            for key in self.lengths.get(length, []):
+                if self.find(key, admin) is None:
+                    continue
+
+                distance = edit_distance(name, key, best_distance - 1)
+                if distance < best_distance:
+                    best, best_distance = key, distance
+
+        self.suggestions[(name, admin)] = best
+        if len(self.suggestions) > 1000:
+            self.suggestions.popitem(last=False)
+
+        return best
 
 # the bot class
 class Bot(Client):
     # initialise the bot
-    def __init__(self):
+    def __init__(self, web_client=None):
         super().__init__()
 
         # open the config file
         self.config = ConfigParser()
         self.config.read('config.cfg')
 
+        # write the log in the background
+        start_logging(self.config)
+
+        # what the last run handed over, if it was started by run.py
+        if environ.get('BOT_HANDOFF'):
+            handoff = loads(environ['BOT_HANDOFF'])
+            log('Last run ended with {} (session {}, sequence {})'.format(handoff.get('reason'), handoff.get('session'), handoff.get('sequence')))
+
+        # why the bot is closing, for run.py
+        self.exit_reason = 'exit'
+
+        # the HTTP client - can be replaced to point requests somewhere else
+        self.web = web_client or WebClient()
+        self.webhook = None
+
+        # the confirmation prompts waiting on replies
+        self.confirmations = ConfirmationRegistry()
+
+        # the command rate limits
+        self.rate_limits = RateLimiter()
+
+        # event name -> queue of events waiting to be handled
+        self.events = {}
+
+        # commands which are still running
+        self.running_commands = set()
+
+        # timings and counts of everything the bot does
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.web.metrics = self.metrics
+        self.metrics.gauge('bot_event_queue_depth', lambda: {(('event', name),): len(queue) for name, queue in self.events.items()}, 'Events waiting to be handled.')
+        self.time_discord_requests()
+
+        # send errors to the admin channel in summaries
+        self.errors = ErrorReporter(lambda summary: self.admin_channel.send(embed=self.response_embed(summary, False)),
+                                    self.config.getfloat('general', 'error_window', fallback=60.))
+
         loop = asyncio.get_event_loop()
 
-        self.ready = asyncio.Event(loop=loop)        
+        self.ready = asyncio.Event(loop=loop)
+
+        # let run.py know the event loop hasn't hung, from logging in onwards
+        asyncio.ensure_future(self.heartbeat())
 
         try:
             loop.run_until_complete(super().start(self.config.get('general', 'token')))
@@ -85,58 +1819,340 @@ class Bot(Client):
 
     # FILE MANAGEMENT
 
-    # read the strikes in from the file
-    async def read_strikes(self):
-        try:
-            with open('strikes.csv', 'r', newline='', encoding='utf-8') as f:
-                sreader = reader(f, delimiter=',', quotechar='\'')
+    # start a change to a user's strikes - waits for any other change to the same user
+    def strike_transaction(self, sid):
+        return StrikeTransaction(self.strike_store, self.strike_locks, sid)
+
+    # get the usernames of a list of users - None for users that no longer exist
+    async def fetch_usernames(self, ids, concurrency=5, batch=20, delay=1.):
+        names = {}
+        missing = []
+
+        # try the cache and then the users we already know about from the gateway
+        for uid in ids:
+            name = self.user_cache.get(uid)
+            if name is None:
+                user = self.get_user(uid)
+                if user:
+                    name = str(user)
+                    self.user_cache.set(uid, name)
+
+            if name is None:
+                missing.append(uid)
+            else:
+                names[uid] = name
 
-                if sreader:
-                    # skip the header line
-                    next(sreader)
-                    
-                    strikes = {}
-                    for line in sreader:
-                        strikes[line[0]] = line[1:]
-
-                    # check if the usernames have changed
-                    for sid in strikes:
-                        try:
-                            user = await self.get_user_info(int(sid))
-                            strikes[sid][0] = str(user)
-                        except NotFound:
-                            # couldn't find user
-                            log('Couldn\'t find user with ID {}'.format(sid))
-                            strikes.pop(sid)
-                else:
-                    # strikes file is empty
-                    strikes = {}
-        except FileNotFoundError:
-            # file not found
-            log('Strikes file is empty - making one')
-            strikes = {}
-        finally:
-            write_strikes(strikes)
-            return strikes
+        # fetch the rest from the API, a few at a time
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(uid):
+            async with semaphore:
+                try:
+                    user = await self.get_user_info(uid)
+                except NotFound:
+                    return uid, None
+
+                self.user_cache.set(uid, str(user))
+                return uid, str(user)
+
+        for i in range(0, len(missing), batch):
+            if i > 0:
+                # leave a gap between batches to stay inside the rate limits
+                await asyncio.sleep(delay)
+
+            for uid, name in await asyncio.gather(*[fetch(uid) for uid in missing[i:i + batch]]):
+                names[uid] = name
+
+        return names
+
+    # close the HTTP client and webhook along with the connection
+    async def close(self):
+        if self.webhook:
+            await self.webhook.stop()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        for queue in self.events.values():
+            queue.stop()
+        if self.ready.is_set():
+            self.save_snapshot()
+
+        # hand over to the next run
+        write_json({'reason': self.exit_reason,
+                    'session': getattr(self.ws, 'session_id', None),
+                    'sequence': getattr(self.ws, 'sequence', None),
+                    'time': time()}, self.config.get('supervisor', 'session', fallback='session.json'))
+        await self.web.close()
+        await super().close()
+
+        # stop any commands still running last - !restart closes the bot from one of them
+        for task in list(self.running_commands):
+            task.cancel()
+
+    # time the requests to the Discord API by route
+    def time_discord_requests(self):
+        request = self.http.request
+
+        async def timed(route, **kwargs):
+            with self.metrics.timer('bot_discord_request', method=route.method, route=route.path):
+                return await request(route, **kwargs)
+
+        self.http.request = timed
 
     # write the config file
     def write_config(self):
         with open('config.cfg', 'w') as f:
             self.config.write(f)
 
+    # write out the role names and IDs, for filling in the config
+    def write_roles(self, roles):
+        with open('roles.txt', 'w') as f:
+            for name, rid in roles:
+                f.write('{} {}\n'.format(name, rid))
+
+    # save the state worked out at startup for the next run
+    def save_snapshot(self):
+        # counts from the last snapshot keep its time until they've been checked, so they still expire if they never are
+        write_json({'guild': self.guild.id,
+                    'time': self.snapshot_time if self.warm_start else time(),
+                    'roles': self.role_counts.counts}, self.config.get('general', 'snapshot', fallback='snapshot.json'))
+
     # UTILITIES
 
+    # check a batch of joins for members with strikes, raising the alarm if a raid has started
+    async def check_joins(self, members, started):
+        try:
+            struck = [(member, strike_level(self.strike_store[str(member.id)])) for member in members if str(member.id) in self.strike_store]
+
+            if started:
+                self.raid = {'joins': 0, 'struck': 0, 'alert': None}
+            if self.raid is not None:
+                self.raid['joins'] += len(members)
+                self.raid['struck'] += len(struck)
+
+            # don't spend the rate limit on messaging raiders - just give out the roles
+            locked = self.joins.locked()
+            semaphore = asyncio.Semaphore(self.config.getint('raid', 'concurrency', fallback=5))
+            results = await asyncio.gather(*[self.warn_struck(member, level, semaphore, not locked) for member, level in struck], return_exceptions=True)
+            for (member, level), result in zip(struck, results):
+                if isinstance(result, Exception):
+                    log('Couldn\'t deal with {}\'s strikes on joining: {}'.format(member, result))
+
+            if started:
+                log('Raid detected - locking down')
+                self.raid['alert'] = await self.admin_channel.send(embed=self.raid_embed())
+            elif self.raid is not None and self.raid['alert'] is not None:
+                await self.raid['alert'].edit(embed=self.raid_embed())
+        except asyncio.CancelledError:
+            # ignore these - spam when bot restarts
+            return
+        except Exception as ex:
+            log('Unhandled {} while checking joins: {}'.format(ex.__class__.__name__, ex))
+            await self.errors.report('while checking joins', ex)
+        finally:
+            # the lockdown has to be ended even if raising the alarm failed
+            if started:
+                asyncio.ensure_future(self.end_lockdown())
+
+    # give a member with strikes their role and let them know about it
+    async def warn_struck(self, member, level, semaphore, message=True):
+        async with semaphore:
+            if message:
+                if level == 1:
+                    # user has 1 strike
+                    await member.send(embed=self.response_embed('You currently have 1 strike. Another strike will result in a 7-day ban. Please follow the rules in the future.', False))
+                else:
+                    # user has 2 strikes
+                    await member.send(embed=self.response_embed('You currently have 2 strikes. Another strike will result in a permanent ban. Please follow the rules in the future.', False))
+
+        await self.role_queue.edit(member, [self.first_strike_role if level == 1 else self.second_strike_role])
+
+    # summarise the current raid
+    def raid_embed(self):
+        if self.joins.locked():
+            summary = 'Raid detected - {} members have joined, {} of them with strikes. Strike roles are still being given out but members aren\'t being messaged. The lockdown will end after {} minutes without a burst of joins.'
+        else:
+            summary = 'Raid over - {} members joined, {} of them with strikes. The lockdown has ended.'
+
+        return self.response_embed(summary.format(self.raid['joins'], self.raid['struck'], round(self.joins.lockdown / 60.)), False)
+
+    # wait out a lockdown and update the alert
+    async def end_lockdown(self):
+        try:
+            while self.joins.locked():
+                await asyncio.sleep(self.joins.until - monotonic())
+
+            log('Raid over - ending lockdown')
+            embed = self.raid_embed()
+            alert, self.raid = self.raid['alert'], None
+            if alert is not None:
+                await alert.edit(embed=embed)
+        except asyncio.CancelledError:
+            # ignore these - spam when bot restarts
+            return
+        except Exception as ex:
+            log('Unhandled {} while ending the lockdown: {}'.format(ex.__class__.__name__, ex))
+            await self.errors.report('while ending the lockdown', ex)
+
+    # give a user their next strike, banning them if it's their second or third
+    async def give_strike(self, txn, target, reason, by):
+        name = target.name
+        sid = str(target.id)
+        record = txn.record
+
+        if record is None:
+            txn.record = [str(target), reason, '', '', '']
+            await self.role_queue.edit(target, [self.first_strike_role], [self.first_strike_role, self.second_strike_role])
+            await target.send(embed=self.response_embed('You have been given a first strike for "{}". One more strike will result in a 7-day ban. Please follow the rules in future.'.format(reason), False))
+            return '{} has been given a first strike by {} for "{}".'.format(name, by, reason)
+        elif strike_level(record) == 1:
+            record[2] = reason
+            # unban_date = (datetime.now() + timedelta(days=7.)).strftime('%Y-%m-%d %H:%M')
+            unban_date = (datetime.now() + timedelta(minutes=1.)).strftime('%Y-%m-%d %H:%M')
+            record[4] = unban_date
+            self.unbans.schedule(sid, parse_unban(unban_date))
+            await target.send(embed=self.response_embed('You have been given a 7-day ban (second strike) for "{}". You will be unbanned at {}.'.format(reason, unban_date), False))
+            await self.guild.ban(target, reason=' '.join(['{}. {}'.format(i+1, record[i+1]) for i in range(2)]+[unban_date]))
+            return '{} has been given a 7-day ban (second strike) by {} for "{}". They will be unbanned at {}.'.format(name, by, reason, unban_date)
+        else:
+            record[3] = reason
+            record[4] = 'never'
+            self.unbans.cancel(sid)
+            await target.send(embed=self.response_embed('You have been given a permanent ban (third strike) for "{}".'.format(reason), False))
+            await self.guild.ban(target, reason=' '.join(['{}. {}'.format(i+1, record[i+1]) for i in range(3)]+['Permanent ban']))
+            return '{} has been given a permanent ban (third strike) by {} for "{}".'.format(name, by, reason)
+
+    # take away a user's latest strike, unbanning them if they're banned
+    async def remove_strike(self, txn, target_user, by, banned):
+        sid = str(target_user.id)
+
+        record = txn.record
+        if record is None:
+            raise CommandError('Cannot find striked user "{}". Check the strikes file'.format(target_user.name))
+
+        target_member = self.guild.get_member(int(sid))
+
+        if strike_level(record) == 1:
+            # 1 strike
+
+            # remove them from the strikes file
+            txn.record = None
+            self.unbans.cancel(sid)
+
+            if target_member:
+                # remove the strike roles
+                await self.role_queue.edit(target_member, remove=[self.first_strike_role, self.second_strike_role])
+                await target_user.send(embed=self.response_embed('Your first strike has been removed.'))
+
+            return '{}\'s first strike has been removed by {}.'.format(target_user, by)
+        elif strike_level(record) == 2:
+            # 2 strikes
+            record[2] = ''
+            record[4] = ''
+            self.unbans.cancel(sid)
+
+            if banned:
+                # target user is banned
+                await self.guild.unban(target_user)
+                return '{}\'s second strike has been removed by {} and they have been unbanned.'.format(target_user, by)
+            else:
+                # target user is not banned
+                if target_member:
+                    # edit the strike roles
+                    await self.role_queue.edit(target_member, [self.first_strike_role], [self.first_strike_role, self.second_strike_role])
+                    await target_user.send(embed=self.response_embed('Your second strike has been removed.'))
+
+                return '{}\'s second strike has been removed by {}.'.format(target_user, by)
+        else:
+            # 3 strikes
+            record[3] = ''
+            record[4] = ''
+            self.unbans.cancel(sid)
+
+            if banned:
+                # target user is banned
+                await self.guild.unban(target_user)
+                return '{}\'s third strike has been removed by {} and they have been unbanned.'.format(target_user, by)
+            else:
+                # target user is not banned
+                if target_member:
+                    # edit the strike roles
+                    await self.role_queue.edit(target_member, [self.second_strike_role], [self.first_strike_role, self.second_strike_role])
+                    await target_user.send(embed=self.response_embed('Your third strike has been removed.'))
+
+                return '{}\'s third strike has been removed by {}.'.format(target_user, by)
+
+    # find the users a bulk command is for - the pings or IDs up to the first other argument
+    async def bulk_targets(self, args):
+        users = []
+        missing = []
+        for i, arg in enumerate(args):
+            uid = arg.strip('<@!>')
+            if not uid.isdigit():
+                break
+
+            user = self.guild.get_member(int(uid)) or self.get_user(int(uid))
+            if user is None:
+                try:
+                    user = await self.get_user_info(int(uid))
+                except NotFound:
+                    missing.append(arg)
+                    continue
+
+            if user.id not in {u.id for u in users}:
+                users.append(user)
+        else:
+            i = len(args)
+
+        return users, missing, args[i:]
+
+    # run an action for many users at once, showing how it's going in a single embed edited in place
+    async def run_bulk(self, channel, title, jobs, failed=[], update=1.):
+        semaphore = asyncio.Semaphore(self.config.getint('strikes', 'concurrency', fallback=5))
+        done = []
+        failed = list(failed)
+
+        def progress(finished=False):
+            lines = done + ['Failed: ' + line for line in failed]
+            if finished:
+                description = '\n'.join(lines)
+                if len(description) > 2000:
+                    description = description[:2000] + '\n...'
+            else:
+                description = '{}/{} done, {} failed.'.format(len(done), len(jobs), len(failed))
+
+            return Embed(title=title, description=description, color=0xff0000 if failed else 0x00ff00)
+
+        async def run(name, job):
+            async with semaphore:
+                try:
+                    done.append(await job())
+                except CommandError as ex:
+                    failed.append(str(ex))
+                except Exception as ex:
+                    log('Bulk {} failed for {}: {}'.format(title.lower(), name, ex))
+                    failed.append('{} ({})'.format(name, ex.__class__.__name__))
+
+        message = await channel.send(embed=progress())
+        tasks = asyncio.ensure_future(asyncio.gather(*[run(name, job) for name, job in jobs]))
+
+        # edit the embed now and then rather than for every user, to stay clear of the rate limits
+        shown = 0
+        while not tasks.done():
+            await asyncio.wait([tasks], timeout=update)
+            if not tasks.done() and len(done) + len(failed) != shown:
+                shown = len(done) + len(failed)
+                await message.edit(embed=progress())
+
+        await message.edit(embed=progress(True))
+        return len(done), len(failed)
+
     # confirm a command
     async def confirm(self, member, channel, prompt, timeout=60.):
-        # check message is from the user
-        def check(message):
-            return message.author == member and message.channel == channel
-
         try:
             while True:
                 await channel.send(embed=self.response_embed('{} (y/n)'.format(prompt)))
-                
-                message = await self.wait_for('message', check=check, timeout=timeout)
+
+                message = await self.confirmations.wait(channel, member, timeout)
 
                 response = message.content.strip().lower()
 
@@ -150,6 +2166,61 @@ class Bot(Client):
         except asyncio.TimeoutError:
             await channel.send(embed=self.response_embed('Timed out after {} seconds.'.format(int(timeout)), False))
             return False
+        except SupersededError:
+            await channel.send(embed=self.response_embed('Cancelled "{}" - a newer prompt is waiting for your answer.'.format(prompt), False))
+            return False
+
+    # announce streams which have gone live and show the current one in the presence
+    async def show_streams(self, went_live):
+        for stream in went_live:
+            await self.stream_channel.send(embed=self.stream_embed(stream))
+
+        stream = self.streams.current()
+        if stream is None:
+            # nothing is streaming - use default presence
+            self.presence.clear('stream')
+        else:
+            # a stream is live - use streaming presence
+            self.presence.override('stream', Streaming(name=stream['channel']['status'], details=stream['channel']['game'], url=stream['channel']['url']), 10)
+
+    # the URL of a Twitch API endpoint
+    def twitch_url(self, path, **params):
+        params['client_id'] = self.config.get('general', 'twitch_client_id', fallback='6r0rm3qhbmjjq4z6vz4hez56tc9m4o')
+        return '{}/{}?{}'.format(self.config.get('general', 'twitch_api', fallback='https://api.twitch.tv/kraken'),
+                                 path,
+                                 urlencode(params))
+
+    # confirm a batch of things in one prompt, returning whether each one was confirmed
+    async def confirm_batch(self, member, channel, prompts, timeout=60.):
+        listing = '\n'.join('{}. {}'.format(i + 1, prompt) for i, prompt in enumerate(prompts))
+        if len(listing) > 1900:
+            # keep within the embed limit - the numbers past the cut still work
+            listing = listing[:listing.rfind('\n', 0, 1900)] + '\n...'
+
+        try:
+            while True:
+                await channel.send(embed=self.response_embed('{}\n(y/n, or the numbers to confirm e.g. "1 3")'.format(listing)))
+
+                message = await self.confirmations.wait(channel, member, timeout)
+
+                response = message.content.strip().lower()
+
+                if response in ['y', 'yes']:
+                    return [True] * len(prompts)
+                elif response in ['n', 'no']:
+                    await channel.send(embed=self.response_embed('Aborted.'))
+                    return [False] * len(prompts)
+                elif response.replace(',', ' ').split() and all(n.isdigit() and 1 <= int(n) <= len(prompts) for n in response.replace(',', ' ').split()):
+                    chosen = {int(n) - 1 for n in response.replace(',', ' ').split()}
+                    return [i in chosen for i in range(len(prompts))]
+                else:
+                    await channel.send(embed=self.response_embed('Didn\'t recognise "{}".'.format(message.content.strip()), False))
+        except asyncio.TimeoutError:
+            await channel.send(embed=self.response_embed('Timed out after {} seconds.'.format(int(timeout)), False))
+            return [False] * len(prompts)
+        except SupersededError:
+            await channel.send(embed=self.response_embed('Cancelled the earlier batch - a newer prompt is waiting for your answer.', False))
+            return [False] * len(prompts)
 
     # replace a command prefix token with the command prefix
     def rcpfx(self, text):
@@ -157,83 +2228,149 @@ class Bot(Client):
         
     # process the command in a channel
     async def process_commands(self, message, member, content):
-        command, *args = content.split()
-        command = command.replace(self.command_prefix, '', 1).lower()
+        command, args = self.router.parse(content)
         channel = message.channel
+        admin = channel == self.admin_channel
+
+        entry = self.router.find(command, admin)
+        if entry is not None:
+            # check the command's rate limits - the admin channel doesn't have any
+            key = None if admin else self.throttled(entry['name'], entry['cmd'].cooldown, entry['cmd'].channel_cooldown, member, channel)
+            if key is not None:
+                if self.config.getboolean('general', 'throttle_reply', fallback=True) and self.rate_limits.warn(key):
+                    return await channel.send(embed=self.response_embed('Slow down! Wait a bit before using "{}{}" again.'.format(self.command_prefix, entry['name']), False))
+                else:
+                    return
 
-        if command in self.commands and (channel == self.admin_channel or not self.commands[command]['admin_only']):
-            return await self.commands[command]['cmd'](*args, member=member, channel=channel, roles=message.role_mentions, mentions=message.mentions)
+            # run the command on its own, so one waiting on a confirmation doesn't hold up a message worker
+            task = asyncio.ensure_future(entry['cmd'](*args, member=member, channel=channel, roles=message.role_mentions, mentions=message.mentions))
+            self.running_commands.add(task)
+            task.add_done_callback(self.running_commands.discard)
+            return task
         else:
-            return await channel.send(embed=self.response_embed('Command "{0}{1}" not found. Use "{0}help" to get the list of commands.'.format(self.command_prefix, command), False))
+            # unknown commands share a rate limit, and over it they're ignored without a reply
+            if not admin and self.throttled('unknown', (3, 30.), (10, 30.), member, channel) is not None:
+                return
+
+            suggestion = self.router.suggest(command, admin)
+            hint = ' Did you mean "{}{}"?'.format(self.command_prefix, suggestion) if suggestion else ''
+            return await channel.send(embed=self.response_embed('Command "{0}{1}" not found.{2} Use "{0}help" to get the list of commands.'.format(self.command_prefix, command, hint), False))
+
+    # check a command against its per-user and per-channel rate limits, returning the key of any it's over
+    def throttled(self, name, cooldown, channel_cooldown, member, channel):
+        for key, limit in [((name, 'user', member.id), cooldown),
+                           ((name, 'channel', channel.id), channel_cooldown)]:
+            if limit is not None and not self.rate_limits.allow(key, *limit):
+                return key
+
+        return None
 
     # WRAPPERS
 
-    # event wrapper
-    def event(wait_until_ready=True):
+    # event wrapper - events go through a bounded queue with a fixed number of workers unless queued is off
+    def event(wait_until_ready=True, queued=True, workers=4, size=1000, overflow='drop_oldest', key=None, merge=None, intercept=None, on_drop=None):
         def wrapper(func):
             func.bot_event = True
-            
+
             @wraps(func)
             async def sub_wrapper(self, *args, **kwargs):
+                # intercepted events are dealt with straight away and go no further
+                if intercept is not None and intercept(self, *args, **kwargs):
+                    return
+
+                if queued:
+                    if func.__name__ not in self.events:
+                        self.events[func.__name__] = EventQueue(lambda *args, **kwargs: run(self, *args, **kwargs),
+                                                                workers, size, overflow, key, merge,
+                                                                (lambda: on_drop(self)) if on_drop is not None else None)
+                    return self.events[func.__name__].put(args, kwargs)
+                else:
+                    return await run(self, *args, **kwargs)
+
+            async def run(self, *args, **kwargs):
                 if wait_until_ready:
                     # wait until the bot is ready
                     await self.ready.wait()
                     
-                try:
-                    return await func(self, *args, **kwargs)
-                except asyncio.CancelledError:
-                    # ignore these - spam when bot restarts
-                    return
-                except Exception as ex:
-                    err = 'Unhandled {} in event {}: {}'.format(ex.__class__.__name__,
-                                                                func.__name__,
-                                                                ex)
-                    log(err)
-                    return self.admin_channel.send(embed=self.response_embed(err, False))
-                    
+                with self.metrics.timer('bot_event', event=func.__name__) as timer:
+                    try:
+                        return await func(self, *args, **kwargs)
+                    except asyncio.CancelledError:
+                        # ignore these - spam when bot restarts
+                        timer.result = 'cancelled'
+                        return
+                    except Exception as ex:
+                        timer.result = 'error'
+                        err = 'Unhandled {} in event {}: {}'.format(ex.__class__.__name__,
+                                                                    func.__name__,
+                                                                    ex)
+                        log(err)
+                        return await self.errors.report('in event {}'.format(func.__name__), ex)
+
             return sub_wrapper
         return wrapper
 
     # command wrapper
-    def command(description, usage='', admin_only=False, category='General'):
+    def command(description, usage='', admin_only=False, category='General', aliases=(), schema=None, cooldown=None, channel_cooldown=None):
         def wrapper(func):
             func.bot_command = True
             func.description = description
             func.usage = usage
             func.admin_only = admin_only
             func.category = category
+            func.aliases = aliases
+            func.schema = schema
+
+            # (uses, seconds) rate limits for each user and each channel
+            func.cooldown = cooldown
+            func.channel_cooldown = channel_cooldown
             
             @wraps(func)
             async def sub_wrapper(self, *args, **kwargs):
+                start = monotonic()
+                result = 'ok'
                 try:
+                    # check the arguments before running the command
+                    if schema is not None:
+                        args = schema.parse(args, kwargs['mentions'], kwargs['roles'])
+
                     response = await func(self, *args, **kwargs)
                     success = True
                 except UsageError as ex:
+                    result = 'usage'
                     response = 'Correct usage is "{}{} {}"{}'.format(self.command_prefix,
                                                                      func.__name__,
                                                                      self.rcpfx(usage),
                                                                      ex)
                     success = False
                 except CommandError as ex:
+                    result = 'failed'
                     response = str(ex)
                     success = False
                 except asyncio.CancelledError:
                     # ignore these - spam when bot restarts
+                    result = 'cancelled'
                     return
                 except Exception as ex:
                     # unhandled exception
+                    result = 'error'
                     err = 'Unhandled {} in command {}{} by {}: {}'.format(ex.__class__.__name__,
                                                                           self.command_prefix,
                                                                           func.__name__,
                                                                           kwargs['member'],
                                                                           ex)
                     log(err)
-                    print(self.admin_channel)
-                    await self.admin_channel.send(embed=self.response_embed(err, False))
+                    await self.errors.report('in command {}{}'.format(self.command_prefix, func.__name__), ex)
                     response = 'Sorry, that command failed.'
                     success = False
                 finally:
-                    if isinstance(response, Embed):
+                    # the time taken doesn't include sending the response, as Discord requests are timed separately
+                    self.metrics.observe('bot_command_seconds', monotonic() - start, command=func.__name__)
+                    self.metrics.inc('bot_commands_total', command=func.__name__, result=result)
+
+                    if result == 'cancelled':
+                        return
+                    elif isinstance(response, Embed):
                         return await kwargs['channel'].send(embed=response)
                     else:
                         return await kwargs['channel'].send(embed=self.response_embed(response, success))
@@ -262,12 +2399,16 @@ class Bot(Client):
                                                                                  func.__name__,
                                                                                  ex)
                     log(err)
-                    return await self.admin_channel.send(err)
+                    return await self.errors.report('while starting up process {}'.format(func.__name__), ex, True)
                 
                 # run the process
                 while kwargs['state'] == 'run':
+                    # processes can change how long to wait between runs - errors always wait the full period
+                    delay = period
                     try:
-                        kwargs = await func(self, **kwargs)
+                        with self.metrics.timer('bot_process', process=func.__name__):
+                            kwargs = await func(self, **kwargs)
+                        delay = kwargs.get('period', period)
                     except asyncio.CancelledError:
                         # ignore these - spam when bot restarts
                         return
@@ -276,12 +2417,12 @@ class Bot(Client):
                                                                       func.__name__,
                                                                       ex)
                         log(err)
-                        await self.admin_channel.send(err)
+                        await self.errors.report('in process {}'.format(func.__name__), ex)
                         if not retry:
                             kwargs['continue'] = 'end'
                             break
                     finally:
-                        await asyncio.sleep(period)
+                        await asyncio.sleep(delay)
 
                 # finish the process
                 try:
@@ -294,7 +2435,7 @@ class Bot(Client):
                                                                                    func.__name__,
                                                                                    ex)
                     log(err)
-                    return await self.admin_channel.send(err)
+                    return await self.errors.report('while shutting down process {}'.format(func.__name__), ex, True)
                 
             return sub_wrapper
         return wrapper
@@ -308,11 +2449,39 @@ class Bot(Client):
                       color=self.admin_role.colour if cmd.admin_only else self.member_role.colour)
         embed.set_author(name='Esports Bot',
                          icon_url=self.user.avatar_url)
+        if cmd.aliases:
+            embed.add_field(name='Aliases', value=', '.join('{}{}'.format(self.command_prefix, alias) for alias in cmd.aliases))
         if cmd.admin_only:
             embed.set_footer(text='Admin-only command.')
 
         return embed
     
+    # the embed for a command, made the first time it's asked for
+    def command_embed(self, entry):
+        if entry['embed'] is None:
+            entry['embed'] = self.cmd_embed(entry['cmd'])
+
+        return entry['embed']
+
+    # the help embeds
+    def make_help_embeds(self):
+        self.help_embed = Embed(title='Commands',
+                                color=self.member_role.colour)
+        self.help_embed.set_author(name='UoM Esports Bot',
+                                   icon_url=self.user.avatar_url)
+        for category in ['General', 'Games', 'Roles']:
+            self.help_embed.add_field(name=category,
+                                      value='\n'.join(['{}{}'.format(self.command_prefix, command) for command, entry in self.router.commands.items() if not entry['admin_only'] and entry['cmd'].category == category]),)
+        self.help_embed.set_footer(text='Type "{}help command" to get its usage.'.format(self.command_prefix))
+        self.admin_embed = Embed(title='Admin Commands',
+                                 color=self.admin_role.colour)
+        self.admin_embed.set_author(name='UoM Esports Bot',
+                                    icon_url=self.user.avatar_url)
+        for category in ['General', 'Games', 'Roles']:
+            self.admin_embed.add_field(name=category,
+                                       value='\n'.join(['{0}{1}{2}{0}'.format('**' if entry['admin_only'] else '', self.command_prefix, command) for command, entry in self.router.commands.items() if entry['cmd'].category == category]))
+        self.admin_embed.set_footer(text='Type "{}help command" to get its usage. Admin-only commands have bold formattng.'.format(self.command_prefix))
+
     # response embed
     def response_embed(self, response, success=True):
         embed = Embed(description=response,
@@ -341,74 +2510,142 @@ class Bot(Client):
     # EVENTS
         
     # output to terminal if the bot successfully logs in
-    @event(wait_until_ready=False)
+    @event(wait_until_ready=False, queued=False)
     async def on_ready(self):
         # output information about the bot's login
         log('Logged in as {0}, {0.id}'.format(self.user))
 
-        # command prefix
-        self.command_prefix = self.config.get('general', 'command_prefix')
-
         # read guild variable ids from the config file and intialise them as global variables
         self.guild = self.get_guild(int(self.config.get('general', 'guild')))
 
+        # everything read from the config
+        self.load_settings()
+
+        # this is called again after a new session - the guild, channels and roles are new objects, but everything else carries on
+        if self.ready.is_set():
+            log('Started a new session')
+            return
+
         # bot name
         await self.guild.me.edit(nick=self.config.get('general', 'name'))
 
+        # strikes
+        self.strike_store = open_strikes(self.config)
+        self.user_cache = UserCache()
+        self.strike_locks = KeyedLock()
+
+        # make role changes in batches
+        self.role_queue = RoleQueue(lambda mid: self.guild.get_member(mid))
+
+        # check joins in batches
+        self.joins = JoinBatcher(self.check_joins,
+                                 self.config.getfloat('raid', 'window', fallback=2.),
+                                 self.config.getint('raid', 'threshold', fallback=20),
+                                 self.config.getfloat('raid', 'period', fallback=60.),
+                                 self.config.getfloat('raid', 'lockdown', fallback=600.))
+        self.raid = None
+
+        # count the members of each role - starting from the last run's counts if there are any, which are checked once ready
+        snapshot = read_snapshot(self.config.get('general', 'snapshot', fallback='snapshot.json'),
+                                 self.guild.id,
+                                 self.config.getfloat('general', 'snapshot_age', fallback=86400.))
+        self.warm_start = snapshot is not None
+        self.role_counts = RoleCounter()
+        if snapshot is not None:
+            self.role_counts.counts = Counter({int(rid): count for rid, count in snapshot['roles'].items()})
+            self.snapshot_time = snapshot['time']
+        else:
+            self.role_counts.build(self.guild.members)
+
+        # schedule the unbans
+        self.unbans = UnbanScheduler()
+        for sid, record in self.strike_store.items():
+            self.unbans.schedule(sid, parse_unban(record[4]))
+
+        # the streams - bad stream times are ignored rather than stopping the bot getting ready
+        general = self.config['general']
+        try:
+            times = parse_stream_times(general.get('stream_times', ''))
+        except (ValueError, IndexError) as ex:
+            log('Couldn\'t read the stream times "{}": {}'.format(general.get('stream_times', ''), ex))
+            times = []
+        self.presence = PresenceManager(lambda activity: self.change_presence(activity=activity),
+                                        general.getfloat('presence_window', 15.))
+        self.presence.set_default(Game(self.rcpfx(general.get('presence'))))
+        self.streams = StreamMonitor(self.web,
+                                     lambda batch: self.twitch_url('streams/', channel=','.join(batch)),
+                                     general.get('twitch_channels', '').split() or general.get('twitch_channel', '').split(),
+                                     times,
+                                     general.getfloat('stream_poll', 60.),
+                                     general.getfloat('stream_poll_fast', 20.),
+                                     general.getfloat('stream_poll_slow', 600.))
+
+        # measure how late the event loop runs things
+        asyncio.ensure_future(self.measure_loop_lag())
+
+        # time out confirmation prompts
+        asyncio.ensure_future(self.expire_confirmations())
+
+        # send the error summaries
+        asyncio.ensure_future(self.report_errors())
+
+        # maintain the bots presence
+        asyncio.ensure_future(self.maintain_presence())
+        asyncio.ensure_future(self.update_presence())
+
+        # check the unbans
+        asyncio.ensure_future(self.check_unbans())
+
+        # check the role counts haven't drifted
+        asyncio.ensure_future(self.check_role_counts())
+
+        # record the role counts over time
+        self.role_history = RoleHistory()
+        asyncio.ensure_future(self.record_role_counts())
+
+        # keep the striked users' names up to date
+        asyncio.ensure_future(self.refresh_usernames())
+
+        # ready to go!
+        log('------')
+        self.ready.set()
+
+        asyncio.ensure_future(self.finish_startup())
+
+    # set up the command prefix, channels, roles and commands from the config
+    def load_settings(self):
+        # command prefix
+        self.command_prefix = self.config.get('general', 'command_prefix')
+
         # channels
         self.bot_channel = self.guild.get_channel(int(self.config.get('channels', 'bot')))
         self.admin_channel = self.guild.get_channel(int(self.config.get('channels', 'admin')))
         self.stream_channel = self.guild.get_channel(int(self.config.get('channels', 'stream')))
 
-        self.streaming = None
+        # roles, looked up by ID
+        roles = {role.id: role for role in self.guild.roles}
+        self.admin_role = roles.get(int(self.config.get('roles', 'admin')))
+        self.member_role = roles.get(int(self.config.get('roles', 'member')))
+        self.guest_role = roles.get(int(self.config.get('roles', 'guest')))
+        self.first_strike_role = roles.get(int(self.config.get('roles', 'first_strike')))
+        self.second_strike_role = roles.get(int(self.config.get('roles', 'second_strike')))
 
-        # roles
-        self.admin_role = find(lambda role: role.id == int(self.config.get('roles', 'admin')), self.guild.roles)
-        self.member_role = find(lambda role: role.id == int(self.config.get('roles', 'member')), self.guild.roles)
-        self.guest_role = find(lambda role: role.id == int(self.config.get('roles', 'guest')), self.guild.roles)
-        self.first_strike_role = find(lambda role: role.id == int(self.config.get('roles', 'first_strike')), self.guild.roles)
-        self.second_strike_role = find(lambda role: role.id == int(self.config.get('roles', 'second_strike')), self.guild.roles)
-
-        with open('roles.txt', 'w') as f:
-            for role in self.guild.roles:
-                f.write('{0.name} {0.id}\n'.format(role))
-
-        # produce the list of commands
-        self.commands = {}
+        # produce the list of commands - their embeds are made when they're first asked for
+        self.router = CommandRouter(self.command_prefix)
         for att in dir(self):
             attr = getattr(self, att, None)
             if hasattr(attr, 'bot_command'):
-                self.commands[att] = {'cmd': attr, 'admin_only': attr.admin_only, 'embed': self.cmd_embed(attr)}
+                self.router.add(att, attr)
 
-        # maintain the bots presence
-        asyncio.ensure_future(self.maintain_presence())
-
-        # check the unbans
-        asyncio.ensure_future(self.check_unbans())
+        # the help embeds are made when they're first asked for
+        self.help_embed = None
+        self.admin_embed = None
 
-        # generate the help embeds
-        self.help_embed = Embed(title='Commands',
-                                color=self.member_role.colour)
-        self.help_embed.set_author(name='UoM Esports Bot',
-                                   icon_url=self.user.avatar_url)
-        for category in ['General', 'Games', 'Roles']:
-            self.help_embed.add_field(name=category,
-                                      value='\n'.join(['{}{}'.format(self.command_prefix, command) for command in self.commands if not self.commands[command]['admin_only'] and self.commands[command]['cmd'].category == category]),)
-        self.help_embed.set_footer(text='Type "{}help command" to get its usage.'.format(self.command_prefix))
-        self.admin_embed = Embed(title='Admin Commands',
-                                 color=self.admin_role.colour)
-        self.admin_embed.set_author(name='UoM Esports Bot',
-                                    icon_url=self.user.avatar_url)
-        for category in ['General', 'Games', 'Roles']:
-            self.admin_embed.add_field(name=category,
-                                       value='\n'.join(['{0}{1}{2}{0}'.format('**' if self.commands[command]['admin_only'] else '', self.command_prefix, command) for command in self.commands if self.commands[command]['cmd'].category == category]))
-        self.admin_embed.set_footer(text='Type "{}help command" to get its usage. Admin-only commands have bold formattng.'.format(self.command_prefix))
-        
         # generate the game roles
         self.games = []
         for sid in self.config.get('roles', 'games').split():
             try:
-                role = find(lambda role: role.id == int(sid), self.guild.roles)
+                role = roles.get(int(sid))
 
                 # check if role exists
                 if role:
@@ -421,16 +2658,49 @@ class Bot(Client):
                                                                           sid,
                                                                           ex))
 
-        # write out working game roles to the config file
+        # keep only the working game roles in the config
         self.config.set('roles', 'games', ' '.join([str(role.id) for role in self.games]))
-        self.write_config()
-        
-        # ready to go!
-        log('------')
-        self.ready.set()
+
+    # the startup work that can wait until the bot is ready
+    async def finish_startup(self):
+        # listen for pushed stream notifications - if it can't start, the streams are still polled
+        if self.webhook is None and self.config.getboolean('webhook', 'enabled', fallback=False):
+            if self.config.get('webhook', 'secret', fallback=''):
+                webhook = StreamWebhook(self.config.get('webhook', 'secret'),
+                                        lambda channel, streams: self.dispatch('stream_update', channel, streams))
+                try:
+                    await webhook.start(self.config.get('webhook', 'host', fallback='127.0.0.1'),
+                                        self.config.getint('webhook', 'port', fallback=8080))
+                    self.webhook = webhook
+                except OSError as ex:
+                    log('Couldn\'t start the webhook: {}'.format(ex))
+                    await webhook.stop()
+            else:
+                log('Webhook has no secret set - not starting it')
+
+        # serve the metrics for Prometheus - the bot runs without them if the port can't be used
+        if self.metrics_server is None and self.config.getboolean('metrics', 'enabled', fallback=False):
+            metrics_server = MetricsServer(self.metrics)
+            try:
+                await metrics_server.start(self.config.get('metrics', 'host', fallback='127.0.0.1'),
+                                           self.config.getint('metrics', 'port', fallback=9100))
+                self.metrics_server = metrics_server
+            except OSError as ex:
+                log('Couldn\'t start the metrics server: {}'.format(ex))
+                await metrics_server.stop()
+
+        try:
+            roles = [(role.name, role.id) for role in self.guild.roles]
+            await self.loop.run_in_executor(None, self.write_roles, roles)
+
+            self.write_config()
+            self.save_snapshot()
+        except Exception as ex:
+            log('Unhandled {} while finishing startup: {}'.format(ex.__class__.__name__, ex))
+            await self.errors.report('while finishing startup', ex)
         
-    # check the contents of the message
-    @event()
+    # check the contents of the message - replies to confirmation prompts are picked up before the queue
+    @event(workers=8, intercept=lambda self, message: self.confirmations.resolve(message))
     async def on_message(self, message):
         # process responses if message isn't from user:
         if message.author != self.user and message.channel in [self.bot_channel, self.admin_channel] and not message.author.bot:
@@ -447,86 +2717,235 @@ class Bot(Client):
     # check if a deleted role was a game role
     @event()
     async def on_guild_role_delete(self, role):
+        self.role_counts.counts.pop(role.id, None)
+
         if role in self.games:
             self.games.remove(role)
                         
-    # when a member joins, send them a PM
-    @event()
+    # keep the role counts up to date - queued updates to the same member are merged into one
+    @event(key=lambda before, after: after.id, merge=lambda queued, new: (queued[0], new[1]), on_drop=lambda self: self.role_counts.mark_dirty())
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.role_counts.change(before.roles, after.roles)
+
+    @event(on_drop=lambda self: self.role_counts.mark_dirty())
+    async def on_member_remove(self, member):
+        self.role_counts.remove(member.roles)
+
+    # when a member joins, queue them to have their strikes checked
+    @event(on_drop=lambda self: self.role_counts.mark_dirty())
     async def on_member_join(self, member):
-        # check if they have strikes
-        sid = str(member.id)
-        strikes = await self.read_strikes()
-        if sid in strikes:
-            if strikes[sid][2] == '':
-                # user has 1 strike
-                await member.send(embed=self.response_embed('You currently have 1 strike. Another strike will result in a 7-day ban. Please follow the rules in the future.', False))
-                return await member.add_roles(*[self.first_strike_role])
-            else:
-                # user has 2 strikes
-                await member.send(embed=self.response_embed('You currently have 2 strikes. Another strike will result in a permanent ban. Please follow the rules in the future.', False))
-                return await member.add_roles(*[self.second_strike_role])
+        self.role_counts.add(member.roles)
+        self.user_cache.set(member.id, str(member))
+
+        self.joins.add(member)
+
+    # handle a pushed stream notification - only the latest for each channel matters
+    @event(key=lambda channel, streams: channel)
+    async def on_stream_update(self, channel, streams):
+        if channel not in self.streams.live:
+            log('Got a stream notification for unknown channel {}'.format(channel))
+            return
+
+        if not streams:
+            stream = False
+        elif 'channel' in streams[0]:
+            stream = streams[0]
+        else:
+            # look the stream up so it's in the same format as the polled ones
+            stream = await self.streams.fetch(channel)
+
+        await self.show_streams([stream] if self.streams.update(channel, stream, True) else [])
 
     # PERIODIC COROUTINES
     
     # maintain the bots presence on the server
     @process()
     async def maintain_presence(self, **kwargs):
-        if kwargs['state'] == 'setup':
-            # read in the stream
-            twitch_channel = self.config.get('general', 'twitch_channel')
+        if kwargs['state'] == 'run':
+            # check which streams are live
+            await self.show_streams(await self.streams.poll())
 
-            # read in the default presence
-            kwargs['presence'] = self.rcpfx(self.config.get('general', 'presence'))
-            
-            # the URLs
-            kwargs['stream_URL'] = 'https://twitch.tv/{}'.format(twitch_channel)
-            kwargs['API_URL'] = 'https://api.twitch.tv/kraken/streams/{}?client_id=6r0rm3qhbmjjq4z6vz4hez56tc9m4o'.format(twitch_channel)
-        elif kwargs['state'] == 'run':
-            # check if the stream is live
-            async with ClientSession() as session:
-                async with session.get(kwargs['API_URL']) as resp:
-                    info = await resp.json(content_type='application/json')
+            if self.webhook:
+                # notifications are pushed - only poll to catch any that went missing
+                kwargs['period'] = self.config.getfloat('webhook', 'poll', fallback=600.)
+            else:
+                kwargs['period'] = self.streams.interval(datetime.now())
 
-            if info['stream'] == None:
-                # nothing is streaming - use default presence
+        return kwargs
 
-                self.streaming = False
+    # sample how far behind the event loop is running
+    @process(period=1.)
+    async def measure_loop_lag(self, **kwargs):
+        now = monotonic()
+        if kwargs['state'] == 'run' and 'last' in kwargs:
+            self.metrics.observe('bot_loop_lag_seconds', max(0., now - kwargs['last'] - kwargs['period']))
 
-                await self.change_presence(activity=Game(kwargs['presence']))
-            else:
-                # stream is live - use streaming presence
+        kwargs['last'] = now
+        kwargs['period'] = self.config.getfloat('metrics', 'lag_interval', fallback=1.)
+        return kwargs
 
-                if self.streaming is not None and self.streaming == False:
-                    await self.stream_channel.send(embed=self.stream_embed(info['stream']))
+    # write the heartbeat file for run.py
+    @process(period=10.)
+    async def heartbeat(self, **kwargs):
+        if kwargs['state'] == 'run':
+            write_json({'pid': getpid(), 'time': time()}, self.config.get('supervisor', 'heartbeat', fallback='heartbeat.json'))
+            kwargs['period'] = self.config.getfloat('supervisor', 'heartbeat_interval', fallback=10.)
 
-                self.streaming = True
+        return kwargs
 
-                await self.change_presence(activity=Streaming(name=info['stream']['channel']['status'], details=info['stream']['channel']['game'], url=kwargs['stream_URL']))
+    # compare the role counts with a full count once a day and report any drift - sooner if a dropped member event left them wrong
+    @process(period=60.)
+    async def check_role_counts(self, **kwargs):
+        if kwargs['state'] == 'setup':
+            # a cold start has only just counted everything - counts from a snapshot are checked once startup has settled
+            if self.warm_start:
+                kwargs['due'] = monotonic() + self.config.getfloat('general', 'role_check_delay', fallback=300.)
+            else:
+                kwargs['due'] = monotonic() + 86400.
+        elif kwargs['state'] == 'run':
+            # wait for the member events still queued, as the scan would count them twice
+            if monotonic() < kwargs['due'] and not self.role_counts.dirty:
+                return kwargs
+            if any(len(self.events[name]) for name in ['on_member_join', 'on_member_remove', 'on_member_update'] if name in self.events):
+                return kwargs
+
+            dirty = self.role_counts.dirty
+            drift = self.role_counts.reconcile(self.guild.members)
+            kwargs['due'] = monotonic() + 86400.
+
+            # the counts from the last run will have missed anything that changed while the bot was off
+            if drift and self.warm_start:
+                log('Role counts from the snapshot were corrected for {} roles'.format(len(drift)))
+            elif drift and dirty:
+                log('Role counts were corrected for {} roles after member events were dropped'.format(len(drift)))
+            elif drift:
+                lines = []
+                for rid, (counted, actual) in drift.items():
+                    role = self.guild.get_role(rid)
+                    lines.append('{}: counted {}, actually {}'.format(role.name if role else rid, counted, actual))
+
+                log('Role counts drifted: {}'.format(', '.join(lines)))
+                await self.admin_channel.send(embed=self.response_embed('Role counts had drifted and have been fixed:\n' + '\n'.join(lines), False))
+
+            self.warm_start = False
+            self.save_snapshot()
 
         return kwargs
 
-    # check for unbans
+    # sample the member, guest and game role counts
     @process(period=3600.)
-    async def check_unbans(self, **kwargs):
+    async def record_role_counts(self, **kwargs):
         if kwargs['state'] == 'run':
-            strikes = await self.read_strikes()
+            now = datetime.now()
+            roles = [self.member_role, self.guest_role] + self.games
+            self.role_history.append(now, {role.id: self.role_counts.get(role) for role in roles})
+            self.role_history.downsample(now)
 
-            for sid in strikes:
-                if strikes[sid][4] not in ['', 'never'] and datetime.now() > datetime.strptime(strikes[sid][4], '%Y-%m-%d %H:%M'):
-                    strikes[sid][4] = ''
+        return kwargs
 
-                    target_user = await self.get_user_info(int(sid))
+    # check if the usernames of striked users have changed
+    @process(period=3600.)
+    async def refresh_usernames(self, **kwargs):
+        if kwargs['state'] == 'run':
+            names = await self.fetch_usernames([int(sid) for sid in self.strike_store])
 
-                    if target_user in [entry.user for entry in await self.guild.bans()]:
-                        # user is banned - unban them
-                        await self.guild.unban(target_user)
-                        await self.admin_channel.send(embed=self.response_embed('{} has been automatically unbanned after 7 days.'.format(strikes[sid][0])))
-                    else:
-                        # user is not banned or could not be unbanned
-                        await self.admin_channel.send(embed=self.response_embed('{}\'s 7-day ban has expired but they couldn\'t be unbanned.'.format(strikes[sid][0]), False))
+            updates = {}
+            for sid, record in self.strike_store.items():
+                # leave users which are being changed until next time
+                if self.strike_locks.locked(sid):
+                    continue
+
+                name = names.get(int(sid), record[0])
+
+                if name is None:
+                    # couldn't find user
+                    log('Couldn\'t find user with ID {}'.format(sid))
+                    self.strike_store.pop(sid)
+                    self.unbans.cancel(sid)
+                else:
+                    record[0] = name
+                    updates[sid] = record
+
+            self.strike_store.update(updates)
+
+        return kwargs
+
+    # move the confirmation timer wheel on
+    @process(period=1.)
+    async def expire_confirmations(self, **kwargs):
+        if kwargs['state'] == 'setup':
+            kwargs['period'] = self.confirmations.tick_length
+        elif kwargs['state'] == 'run':
+            self.confirmations.tick()
+
+        return kwargs
+
+    # send a summary of the errors, at most once per window
+    @process()
+    async def report_errors(self, **kwargs):
+        if kwargs['state'] == 'setup':
+            kwargs['period'] = self.errors.window
+        elif kwargs['state'] == 'run':
+            await self.errors.flush()
+
+        return kwargs
+
+    # send presence changes, at most once per window
+    @process()
+    async def update_presence(self, **kwargs):
+        if kwargs['state'] == 'setup':
+            kwargs['period'] = self.presence.window
+        elif kwargs['state'] == 'run':
+            await self.presence.flush()
+
+        return kwargs
+
+    # unban users when their ban runs out
+    @process()
+    async def check_unbans(self, **kwargs):
+        if kwargs['state'] == 'setup':
+            # run again as soon as the wait finishes
+            kwargs['period'] = 0.
+        elif kwargs['state'] == 'run':
+            # sleep until the next unban
+            await self.unbans.wait()
 
-            # write to the strikes file
-            write_strikes(strikes)
+            due = self.unbans.pop_due(datetime.now())
+            if not due:
+                return kwargs
+
+            try:
+                # fetch the bans once for all of the due users
+                banned = {entry.user.id: entry.user for entry in await self.guild.bans()}
+
+                while due:
+                    sid, _ = due[0]
+
+                    # don't hold up the other unbans behind a change to this user - try them again shortly
+                    if self.strike_locks.locked(sid):
+                        self.unbans.schedule(sid, datetime.now() + timedelta(minutes=1.))
+                        due.pop(0)
+                        continue
+
+                    async with self.strike_transaction(sid) as txn:
+                        # check the ban wasn't changed while waiting for the lock
+                        if txn.record is not None and parse_unban(txn.record[4]) is not None and parse_unban(txn.record[4]) <= datetime.now():
+                            txn.record[4] = ''
+
+                            if int(sid) in banned:
+                                # user is banned - unban them
+                                await self.guild.unban(banned[int(sid)])
+                                await self.admin_channel.send(embed=self.response_embed('{} has been automatically unbanned after 7 days.'.format(txn.record[0])))
+                            else:
+                                # user is not banned or could not be unbanned
+                                await self.admin_channel.send(embed=self.response_embed('{}\'s 7-day ban has expired but they couldn\'t be unbanned.'.format(txn.record[0]), False))
+
+                    due.pop(0)
+            finally:
+                # put back anything that didn't get done, to try again after the error
+                for sid, date in due:
+                    self.unbans.schedule(sid, date)
 
         return kwargs
 
@@ -535,19 +2954,23 @@ class Bot(Client):
     # GENERAL
     
     # list the bot commands
-    @command(description='List the bot commands and their usage.', usage='[command]')
+    @command(description='List the bot commands and their usage.', usage='[command]', aliases=('commands',), schema=Args(max=1), cooldown=(3, 30.), channel_cooldown=(10, 30.))
     async def help(self, *args, **kwargs):
         if len(args) == 0:
             # give the correct version of the help text
+            if self.help_embed is None:
+                self.make_help_embeds()
+
             if kwargs['channel'] == self.admin_channel:
                 return self.admin_embed
             else:
                 return self.help_embed
         else:
             # find the command
-            command = args[0].lower().replace(self.command_prefix, '')
-            if command in self.commands and (not self.commands[command]['admin_only'] or kwargs['channel'] == self.admin_channel):
-                return self.commands[command]['embed']
+            command = self.router.name(args[0])
+            entry = self.router.find(command, kwargs['channel'] == self.admin_channel)
+            if entry is not None:
+                return self.command_embed(entry)
             else:
                 raise CommandError('Command "{}{}" not found.'.format(self.command_prefix, command))
 
@@ -557,22 +2980,119 @@ class Bot(Client):
         await kwargs['channel'].send(embed=self.response_embed('Restarting.'))
         log('Restarting the bot')
         log('------')
+        self.exit_reason = 'restart'
         await self.logout()
 
     # test_stream
     @command(description='Generate test stream announcement', admin_only=True)
     async def teststream(self, *args, **kwargs):
         # check if the stream is live
-        async with ClientSession() as session:
-            async with session.get('https://api.twitch.tv/kraken/streams/failarmy?client_id=6r0rm3qhbmjjq4z6vz4hez56tc9m4o') as resp:
-                info = await resp.json(content_type='application/json')
+        info = await self.web.get_json(self.twitch_url('streams/failarmy'), 'twitch')
 
         return self.stream_embed(info['stream'])
 
+    # set the presence for a while
+    @command(description='Show a presence for a number of minutes, over any stream.', usage='<minutes> <text>', admin_only=True, schema=Args(min=2, types=(number,)))
+    async def setpresence(self, *args, **kwargs):
+        self.presence.override('command', Game(' '.join(args[1:])), 20, args[0] * 60.)
+        return 'Presence set for {} minutes.'.format(args[0])
+
+    # reload the commands and config without reconnecting
+    @command(description='Reload the commands and config without restarting.', admin_only=True)
+    async def reload(self, *args, **kwargs):
+        config = ConfigParser()
+        if not config.read('config.cfg'):
+            raise CommandError('Couldn\'t read the config file.')
+
+        # load the latest code alongside the running code
+        try:
+            spec = spec_from_file_location('bot_reload', __file__)
+            module = module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except Exception as ex:
+            raise CommandError('Couldn\'t load the new code - {}: {}'.format(ex.__class__.__name__, ex))
+
+        # the new code has to raise the errors the running code catches, and write to the same log
+        for name in ['UsageError', 'CommandError', 'ConflictError', 'SupersededError', 'log_writer']:
+            setattr(module, name, globals()[name])
+
+        # swap in the new commands and the helpers they use - events, processes and the client's own methods are left alone,
+        # as they're already running or call super(), which only works with the class the bot was made from
+        helpers = ['give_strike', 'remove_strike', 'warn_struck', 'bulk_targets', 'run_bulk', 'confirm', 'confirm_batch',
+                   'rcpfx', 'twitch_url', 'cmd_embed', 'command_embed', 'make_help_embeds', 'response_embed', 'stream_embed',
+                   'raid_embed', 'load_settings', 'write_config']
+        count = 0
+        for name, func in vars(module.Bot).items():
+            if hasattr(func, 'bot_command') or name in helpers:
+                setattr(self, name, MethodType(func, self))
+                count += hasattr(func, 'bot_command')
+
+        self.config = config
+        self.load_settings()
+        self.write_config()
+        self.presence.set_default(Game(self.rcpfx(self.config.get('general', 'presence'))))
+
+        log('Reloaded {} commands and the config'.format(count))
+        return 'Reloaded {} commands and the config.'.format(count)
+
+    # see where the time goes
+    @command(description='See command, event and request timings.', admin_only=True)
+    async def stats(self, *args, **kwargs):
+        def timings(name, label, results, limit=10):
+            counts = self.metrics.counters_by(results, label, 'result')
+            histograms = sorted(self.metrics.histograms_by(name, label).items(), key=lambda item: -item[1].count)[:limit]
+            lines = []
+            for key, histogram in histograms:
+                failed = sum(count for result, count in counts.get(key, {}).items() if result not in ['ok', 'usage'])
+                lines.append('{}: {}, {} failed, p50 {:.0f} ms, p95 {:.0f} ms'.format(key, histogram.count, failed,
+                                                                                   histogram.percentile(50) * 1000,
+                                                                                   histogram.percentile(95) * 1000))
+
+            return '\n'.join(lines) or 'None yet'
+
+        embed = Embed(title='Stats', color=0x00ff00)
+
+        embed.add_field(name='Commands', value=timings('bot_command_seconds', 'command', 'bot_commands_total'), inline=False)
+        embed.add_field(name='Events', value=timings('bot_event_seconds', 'event', 'bot_event_total'), inline=False)
+        embed.add_field(name='Discord requests', value=timings('bot_discord_request_seconds', 'route', 'bot_discord_request_total', 5), inline=False)
+        embed.add_field(name='Other requests', value=timings('bot_http_request_seconds', 'api', 'bot_http_requests_total'), inline=False)
+
+        lag = self.metrics.histograms.get(('bot_loop_lag_seconds', ()))
+        if lag is not None:
+            embed.add_field(name='Event loop lag', value='p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(lag.percentile(50) * 1000,
+                                                                                                        lag.percentile(99) * 1000,
+                                                                                                        lag.max * 1000), inline=False)
+
+        embed.set_author(name='UoM Esports Bot', icon_url=self.user.avatar_url)
+
+        return embed
+
+    # see the event queues
+    @command(description='See the event queues.', admin_only=True)
+    async def queues(self, *args, **kwargs):
+        names = []
+        stats = []
+        for name, queue in sorted(self.events.items()):
+            names.append(name)
+            stats.append('{} queued, {} max, {} done, {} dropped, {} merged'.format(len(queue),
+                                                                                  queue.stats['max_depth'],
+                                                                                  queue.stats['processed'],
+                                                                                  queue.stats['dropped'],
+                                                                                  queue.stats['coalesced']))
+
+        embed = Embed(title='Event queues', color=0x00ff00)
+
+        embed.add_field(name='Event', value='\n'.join(names) or 'None yet')
+        embed.add_field(name='Queue', value='\n'.join(stats) or 'None yet')
+
+        embed.set_author(name='UoM Esports Bot', icon_url=self.user.avatar_url)
+
+        return embed
+
     # GAMES
 
     # list the game roles
-    @command(description='List the game roles.', category='Games')
+    @command(description='List the game roles.', category='Games', aliases=('games',), cooldown=(3, 30.), channel_cooldown=(10, 30.))
     async def listgames(self, *args, **kwargs):
         # get the list of roles
         games = [role.name for role in self.games]
@@ -591,13 +3111,13 @@ class Bot(Client):
 
         games = []
         for role in self.games:
-            games.append((role.name, len(role.members)))
+            games.append((role.name, self.role_counts.get(role)))
 
         games = sorted(games,key=itemgetter(1),reverse=True)
 
         roles = '\n'.join(['**Member**', '**Guest**'] + [role[0] for role in games])
 
-        counts = ['**' + str(len(self.member_role.members)) + '**', '**' + str(len(self.guest_role.members)) + '**']
+        counts = ['**' + str(self.role_counts.get(self.member_role)) + '**', '**' + str(self.role_counts.get(self.guest_role)) + '**']
         for role in games:
             counts.append(str(role[1]))
         counts = '\n'.join(counts)
@@ -611,164 +3131,206 @@ class Bot(Client):
 
         return embed
 
+    # get the role counts over time
+    @command(description='Get how the role counts have changed over a number of days.', usage='<days> [role pings]', admin_only=True, category='Games', schema=Args(min=1, types=(number,)))
+    async def rolehistory(self, *args, **kwargs):
+        end = datetime.now()
+        start = end - timedelta(days=args[0])
+        roles = kwargs['roles'] or [self.member_role, self.guest_role] + self.games
+
+        trends = self.role_history.trends(start, end, {role.id for role in roles})
+        if not trends:
+            raise CommandError('No role counts recorded in the last {} days.'.format(args[0]))
+
+        names = []
+        changes = []
+        for role in roles:
+            if role.id in trends:
+                trend = trends[role.id]
+                names.append(role.name)
+                changes.append('{} → {} ({:+d}, low {}, high {})'.format(trend['first'][1], trend['last'][1], trend['last'][1] - trend['first'][1], trend['min'], trend['max']))
+
+        embed = Embed(title='Role history', description='Since {}'.format(start.strftime('%Y-%m-%d %H:%M')), color=0x00ff00)
+
+        embed.add_field(name='Role', value='\n'.join(names))
+        embed.add_field(name='Change', value='\n'.join(changes))
+
+        embed.set_author(name='UoM Esports Bot', icon_url=self.user.avatar_url)
+
+        return embed
+
     # link game role
-    @command(description='Link game role.', usage='<role ping>', admin_only=True, category='Games')
+    @command(description='Link game role.', usage='<role ping>', admin_only=True, category='Games', schema=Args(min=1, roles=1))
     async def linkgame(self, *args, **kwargs):
-        if len(args) == 0:
-            raise UsageError
-        else:
-            for role in kwargs['roles']:
-                if role.id in self.games:
-                    # role already exists
-                    raise CommandError('"{}" role already exists.'.format(role.name))
-                else:
-                    # role doesn't exist
-                    self.games.append(role)
-                    self.config.set('roles', 'games', ' '.join([str(role.id) for role in self.games]))
-                    self.write_config()
-                    return 'Imported "{}" role.'.format(role.name)
+        for role in kwargs['roles']:
+            if role.id in self.games:
+                # role already exists
+                raise CommandError('"{}" role already exists.'.format(role.name))
+            else:
+                # role doesn't exist
+                self.games.append(role)
+                self.config.set('roles', 'games', ' '.join([str(role.id) for role in self.games]))
+                self.write_config()
+                return 'Imported "{}" role.'.format(role.name)
 
     # unlink a game role
-    @command(description='Unlink a game role.', usage='<role ping>', admin_only=True, category='Games')
+    @command(description='Unlink a game role.', usage='<role ping>', admin_only=True, category='Games', schema=Args(min=1, roles=1))
     async def unlinkgame(self, *args, **kwargs):
-        if len(args) == 0:
-            raise UsageError
-        else:
-            for role in kwargs['roles']:
-                if role in self.games:
-                    # role exists
-                    self.games.remove(role)
-                    self.config.set('roles', 'games', ' '.join([str(role.id) for role in self.games]))
-                    self.write_config()
-                    return 'Deleted "{}" role.'.format(role.name)
-                else:
-                    # role doesn't exist
-                    raise CommandError('"{}" role doesn\'t exist.'.format(role.name))
+        for role in kwargs['roles']:
+            if role in self.games:
+                # role exists
+                self.games.remove(role)
+                self.config.set('roles', 'games', ' '.join([str(role.id) for role in self.games]))
+                self.write_config()
+                return 'Deleted "{}" role.'.format(role.name)
+            else:
+                # role doesn't exist
+                raise CommandError('"{}" role doesn\'t exist.'.format(role.name))
 
     # DISCIPLINE
 
     # strike a user
-    @command(description='Strike a user with a given reason.', usage='<user_ping> <reason>', admin_only=True)
+    @command(description='Strike a user with a given reason.', usage='<user_ping> <reason>', admin_only=True, schema=Args(min=2, mentions=1))
     async def strike(self, *args, **kwargs):
-        if len(args) <= 1 or (not kwargs['mentions']):
-            raise UsageError('"')
-        elif len(kwargs['mentions']) > 1:
-            raise UsageError('Ping a single user.')
-        else:
-            target = kwargs['mentions'][0]
-            name = target.name
-            reason = ' '.join(args[1:])
-
-            if not self.guild.get_member(target.id):
-                raise CommandError('Cannot find member "{}" in this server. '.format(name))
-
-            sid = str(target.id)
-            strikes = await self.read_strikes()
-            if sid in strikes:
-                if strikes[sid][2] == '':
-                    # check if you want to give a 7-day ban
-                    if await self.confirm(kwargs['member'], kwargs['channel'], 'Give {} a 7-day ban?'.format(name)):
-                        strikes[sid][2] = reason
-                        # unban_date = (datetime.now() + timedelta(days=7.)).strftime('%Y-%m-%d %H:%M')
-                        unban_date = (datetime.now() + timedelta(minutes=1.)).strftime('%Y-%m-%d %H:%M')
-                        strikes[sid][4] = unban_date
-                        await target.send(embed=self.response_embed('You have been given a 7-day ban (second strike) for "{}". You will be unbanned at {}.'.format(reason, unban_date), False))
-                        response = '{} has been given a 7-day ban (second strike) by {} for "{}". They will be unbanned at {}.'.format(name, kwargs['member'], reason, unban_date)
-                        await self.guild.ban(target, reason=' '.join(['{}. {}'.format(i+1, strikes[sid][i+1]) for i in range(2)]+[unban_date]))
-                else:
-                    # check if you want to give a permanent ban
-                    if await self.confirm(kwargs['member'], kwargs['channel'], 'Give {} a permanent ban?'.format(name)):
-                        strikes[sid][3] = reason
-                        strikes[sid][4] = 'never'
-                        await target.send(embed=self.response_embed('You have been given a permanent ban (third strike) for "{}".'.format(reason), False))
-                        response = '{} has been given a permanent ban (third strike) by {} for "{}".'.format(name, kwargs['member'], reason)
-                        await self.guild.ban(target, reason=' '.join(['{}. {}'.format(i+1, strikes[sid][i+1]) for i in range(3)]+['Permanent ban']))
-            else:
-                strikes[sid] = [target, reason, '', '', '']
-                await edit_roles(target, [self.first_strike_role], [self.first_strike_role, self.second_strike_role])
-                await target.send(embed=self.response_embed('You have been given a first strike for "{}". One more strike will result in a 7-day ban. Please follow the rules in future.'.format(reason), False))
-                response = '{} has been given a first strike by {} for "{}".'.format(name, kwargs['member'], reason)
-                
-            write_strikes(strikes)
-            return response 
+        target = kwargs['mentions'][0]
+        name = target.name
+        reason = ' '.join(args[1:])
+
+        if not self.guild.get_member(target.id):
+            raise CommandError('Cannot find member "{}" in this server. '.format(name))
+
+        # confirm any ban before taking the lock, so the user's strikes aren't held up while waiting on a reply
+        sid = str(target.id)
+        level = strike_level(self.strike_store[sid]) if sid in self.strike_store else 0
+        if level == 1:
+            # check if you want to give a 7-day ban
+            if not await self.confirm(kwargs['member'], kwargs['channel'], 'Give {} a 7-day ban?'.format(name)):
+                return 'No strike was given to {}.'.format(name)
+        elif level > 1:
+            # check if you want to give a permanent ban
+            if not await self.confirm(kwargs['member'], kwargs['channel'], 'Give {} a permanent ban?'.format(name)):
+                return 'No strike was given to {}.'.format(name)
+
+        async with self.strike_transaction(sid) as txn:
+            if (0 if txn.record is None else strike_level(txn.record)) != level:
+                raise CommandError('{}\'s strikes changed while waiting for confirmation. Check "strikes" and try again.'.format(name))
+
+            return await self.give_strike(txn, target, reason, kwargs['member'])
 
     # de-strike a user
-    @command(description='De-strike a user.', usage='<user_ping>', admin_only=True)
+    @command(description='De-strike a user.', usage='<user_ping>', admin_only=True, schema=Args(mentions=1))
     async def destrike(self, *args, **kwargs):
-        if not kwargs['mentions']:
-            raise UsageError('Ping the user you wish to destrike')
-        elif len(kwargs['mentions']) > 1:
-            raise UsageError('Ping a single user.')
-        else:
-            target_user = kwargs['mentions'][0]
+        target_user = kwargs['mentions'][0]
 
-            sid = str(target_user.id)
-            strikes = await self.read_strikes()
-            banned = target_user in [entry.user for entry in await self.guild.bans()]
+        sid = str(target_user.id)
+        banned = target_user.id in {entry.user.id for entry in await self.guild.bans()}
 
-            if sid in strikes:
-                target_member = self.guild.get_member(int(sid))
+        async with self.strike_transaction(sid) as txn:
+            response = await self.remove_strike(txn, target_user, kwargs['member'], banned)
 
-                if strikes[sid][2] == '':
-                    # 1 strike
+        return response
 
-                    # remove them from the strikes file
-                    strikes.pop(sid)
+    # strike many users at once
+    @command(description='Strike a number of users with the same reason.', usage='<user pings or IDs> <reason>', admin_only=True, schema=Args(min=2))
+    async def strikeall(self, *args, **kwargs):
+        targets, missing, reason = await self.bulk_targets(args)
+        reason = ' '.join(reason)
+        if not targets or not reason:
+            raise UsageError
 
-                    if target_member:
-                        # remove the strike roles
-                        await target_member.remove_roles(*[self.first_strike_role, self.second_strike_role])
-                        await target_user.send(embed=self.response_embed('Your first strike has been removed.'))
-                        
-                    response = '{}\'s first strike has been removed by {}.'.format(target_user, kwargs['member'])
-                elif strikes[sid][3] == '':
-                    # 2 strikes
-                    strikes[sid][2] = ''
-                    strikes[sid][4] = ''
-
-                    if banned:
-                        # target user is banned
-                        await self.guild.unban(target_user)
-                        response = '{}\'s second strike has been removed by {} and they have been unbanned.'.format(target_user, kwargs['member'])
-                    else:
-                        # target user is not banned
-                        if target_member:
-                            # edit the strike roles
-                            await edit_roles(target_member, [self.first_strike_role], [self.first_strike_role, self.second_strike_role])
-                            await target_user.send(embed=self.response_embed('Your second strike has been removed.'))
-                            
-                        response = '{}\'s second strike has been removed by {}.'.format(target_user, kwargs['member'])
-                else:
-                    # 3 strikes
-                    strikes[sid][3] = ''
-                    strikes[sid][4] = ''
-
-                    if banned:
-                        # target user is banned
-                        await self.guild.unban(target_user)
-                        response = '{}\'s third strike has been removed by {} and they have been unbanned.'.format(target_user, kwargs['member'])
-                    else:
-                        # target user is not banned
-                        if target_member:
-                            # edit the strike roles
-                            await edit_roles(target_member, [self.second_strike_role], [self.first_strike_role, self.second_strike_role])
-                            await target_user.send(embed=self.response_embed('Your third strike has been removed.'))
-                            
-                        response = '{}\'s third strike has been removed by {}.'.format(target_user, kwargs['member'])
-
-                write_strikes(strikes)
-                return response
+        failed = ['Cannot find user "{}".'.format(arg) for arg in missing]
+        members = []
+        for target in targets:
+            if self.guild.get_member(target.id):
+                members.append(target)
             else:
-                raise CommandError('Cannot find striked user "{}". Check the strikes file'.format(target_user.name))
+                failed.append('Cannot find member "{}" in this server.'.format(target.name))
+
+        # what each strike will do, so it can be checked it hasn't changed by the time it's made
+        levels = [strike_level(self.strike_store[str(member.id)]) if str(member.id) in self.strike_store else 0 for member in members]
+        actions = ['First strike for {}', '7-day ban (second strike) for {}', 'Permanent ban (third strike) for {}', 'Permanent ban (third strike) for {}']
+        chosen = await self.confirm_batch(kwargs['member'], kwargs['channel'], [actions[level].format(member) for member, level in zip(members, levels)]) if members else []
+
+        def job(member, level):
+            async def give():
+                async with self.strike_transaction(str(member.id)) as txn:
+                    if (0 if txn.record is None else strike_level(txn.record)) != level:
+                        raise CommandError('{}\'s strikes changed before they could be struck.'.format(member.name))
+                    return await self.give_strike(txn, member, reason, kwargs['member'])
+            return give
+
+        jobs = [(str(member), job(member, level)) for member, level, ok in zip(members, levels, chosen) if ok]
+        if not jobs and not failed:
+            return 'Nobody was struck.'
+
+        done, errors = await self.run_bulk(kwargs['channel'], 'Strikes', jobs, failed)
+        return '{} struck {} users, {} failed.'.format(kwargs['member'], done, errors)
+
+    # ban many users at once
+    @command(description='Ban a number of users with the same reason.', usage='<user pings or IDs> <reason>', admin_only=True, schema=Args(min=2))
+    async def banall(self, *args, **kwargs):
+        targets, missing, reason = await self.bulk_targets(args)
+        reason = ' '.join(reason)
+        if not targets or not reason:
+            raise UsageError
+
+        failed = ['Cannot find user "{}".'.format(arg) for arg in missing]
+        chosen = await self.confirm_batch(kwargs['member'], kwargs['channel'], ['Ban {}'.format(target) for target in targets])
+
+        def job(target):
+            async def ban():
+                async with self.strike_transaction(str(target.id)) as txn:
+                    await self.guild.ban(target, reason=reason)
+
+                    # a ban shouldn't be lifted when a 7-day one runs out
+                    if txn.record is not None and txn.record[4] not in ('', 'never'):
+                        txn.record[4] = 'never'
+                        self.unbans.cancel(str(target.id))
+                return '{} has been banned by {} for "{}".'.format(target, kwargs['member'], reason)
+            return ban
+
+        jobs = [(str(target), job(target)) for target, ok in zip(targets, chosen) if ok]
+        if not jobs and not failed:
+            return 'Nobody was banned.'
+
+        done, errors = await self.run_bulk(kwargs['channel'], 'Bans', jobs, failed)
+        return '{} banned {} users, {} failed.'.format(kwargs['member'], done, errors)
+
+    # de-strike many users at once
+    @command(description='De-strike a number of users.', usage='<user pings or IDs>', admin_only=True, schema=Args(min=1))
+    async def destrikeall(self, *args, **kwargs):
+        targets, missing, rest = await self.bulk_targets(args)
+        if not targets or rest:
+            raise UsageError
+
+        failed = ['Cannot find user "{}".'.format(arg) for arg in missing]
+        for target in targets:
+            if str(target.id) not in self.strike_store:
+                failed.append('Cannot find striked user "{}". Check the strikes file'.format(target.name))
+        targets = [target for target in targets if str(target.id) in self.strike_store]
+
+        chosen = await self.confirm_batch(kwargs['member'], kwargs['channel'], ['Remove a strike from {}'.format(target) for target in targets]) if targets else []
+        banned = {entry.user.id for entry in await self.guild.bans()}
+
+        def job(target):
+            async def destrike():
+                async with self.strike_transaction(str(target.id)) as txn:
+                    return await self.remove_strike(txn, target, kwargs['member'], target.id in banned)
+            return destrike
+
+        jobs = [(str(target), job(target)) for target, ok in zip(targets, chosen) if ok]
+        if not jobs and not failed:
+            return 'Nobody was de-striked.'
+
+        done, errors = await self.run_bulk(kwargs['channel'], 'De-strikes', jobs, failed)
+        return '{} de-striked {} users, {} failed.'.format(kwargs['member'], done, errors)
 
     @command(description='See current active strike(s).', admin_only=True)
     async def strikes(self, *args, **kwargs):
-        strikes = await self.read_strikes()
-
         strike_string = ''
 
-        for sid in strikes:
-            strike_string += '**' + strikes[sid][0] + '**: ' + strikes[sid][1] + '\n'
+        for sid, record in self.strike_store.items():
+            strike_string += '**' + record[0] + '**: ' + record[1] + '\n'
 
         embed = Embed(color=0x00ff00)
 
@@ -780,12 +3342,10 @@ class Bot(Client):
 
     @command(description='Get ids of members with strikes. Useful for `!destrike`', admin_only=True)
     async def strikeids(self, *args, **kwargs):
-        strikes = await self.read_strikes()
-
         strike_string = ''
 
-        for sid in strikes:
-            strike_string += '**' + strikes[sid][0] + '**: ' + sid + '\n'
+        for sid, record in self.strike_store.items():
+            strike_string += '**' + record[0] + '**: ' + sid + '\n'
 
         embed = Embed(color=0x00ff00)
 
@@ -800,9 +3360,10 @@ class Bot(Client):
     @command(description='See the strikes file.', admin_only=True)
     async def strikesfile(self, *args, **kwargs):
         await kwargs['member'].send(embed=self.response_embed('The strikes file.'),
-                                    file=File(fp='strikes.csv'))
+                                    file=File(fp=self.strike_store.export()))
 
         return 'DM\'d.'
 
 # start the bot
-Bot()
+if __name__ == '__main__':
+    Bot()
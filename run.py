@@ -1,14 +1,110 @@
 # run.py
 
-from os import listdir
-from subprocess import call
+from configparser import ConfigParser
+from datetime import datetime
+from json import dumps, loads
+from os import environ, listdir, remove
+from os.path import getmtime, isfile
+from random import uniform
+from subprocess import Popen, TimeoutExpired
+from time import sleep, time
+
+# print with the time, like the bot's log
+def log(message):
+    print('[{}]: {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M'), message), flush=True)
+
+# read and remove a file the bot left behind - None if there isn't one
+def take_json(filename):
+    if not isfile(filename):
+        return None
+
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return loads(f.read())
+    except (OSError, ValueError):
+        return None
+    finally:
+        remove(filename)
+
+# check whether the bot has written its heartbeat recently
+def alive(filename, started, timeout):
+    # give it until the timeout to write the first one
+    last = getmtime(filename) if isfile(filename) else 0.
+    return time() - max(last, started) < timeout
+
+# stop the bot, killing it if it won't stop
+def stop(child, wait=10.):
+    child.terminate()
+    try:
+        child.wait(wait)
+    except TimeoutExpired:
+        child.kill()
+        child.wait()
+
+crashes = []
+failures = 0
+handoff = {}
 
 while True:
     # check if the config file exists
-    if 'config.cfg' in listdir():
-        # file exists - run the bot as a subprocess
-        call(['python3', 'bot.py'])
-    else:
+    if 'config.cfg' not in listdir():
         # file doesn't exist - close the program
         print('Config file not found.')
         raise SystemExit
+
+    config = ConfigParser()
+    config.read('config.cfg')
+    supervisor = config['supervisor'] if config.has_section('supervisor') else {}
+    heartbeat = supervisor.get('heartbeat', 'heartbeat.json')
+    session = supervisor.get('session', 'session.json')
+    timeout = float(supervisor.get('heartbeat_timeout', 120.))
+
+    # clear out anything left by an earlier run
+    for filename in [heartbeat, session]:
+        if isfile(filename):
+            remove(filename)
+
+    # run the bot as a subprocess, passing on what the last run handed over
+    started = time()
+    child = Popen(['python3', 'bot.py'], env=dict(environ, BOT_HANDOFF=dumps(handoff)))
+
+    # kill it if its event loop stops writing the heartbeat
+    hung = False
+    while child.poll() is None:
+        sleep(1.)
+        if child.poll() is None and not alive(heartbeat, started, timeout):
+            log('Bot hasn\'t written a heartbeat for {} seconds - killing it'.format(int(timeout)))
+            stop(child)
+            hung = True
+
+    # the bot writes the session file when it closes - without one it crashed
+    handoff = take_json(session) or {'reason': 'crash' if child.returncode else 'exit'}
+    if hung:
+        handoff['reason'] = 'hang'
+    handoff['code'] = child.returncode
+    ran = time() - started
+
+    if handoff['reason'] == 'restart':
+        # asked to restart - go straight away
+        failures = 0
+        continue
+
+    # a run that lasted long enough means the bot is healthy again
+    if ran >= float(supervisor.get('stable', 300.)):
+        failures = 0
+
+    failures += 1
+    if handoff['reason'] in ['crash', 'hang']:
+        crashes = [t for t in crashes if t > time() - float(supervisor.get('crash_window', 600.))] + [time()]
+
+    # back off exponentially with jitter so a broken start doesn't hammer the login endpoint
+    if len(crashes) >= int(supervisor.get('crash_limit', 5)):
+        delay = float(supervisor.get('crash_pause', 1800.))
+        crashes = []
+        log('Bot is crashing over and over - waiting {} seconds before trying again'.format(int(delay)))
+    else:
+        delay = min(float(supervisor.get('backoff_max', 300.)), float(supervisor.get('backoff_min', 1.)) * 2 ** (failures - 1))
+        delay = uniform(delay / 2, delay)
+        log('Bot stopped ({}, exit code {}) after {} seconds - restarting in {:.1f} seconds'.format(handoff['reason'], child.returncode, int(ran), delay))
+
+    sleep(delay)